@@ -6,9 +6,9 @@ import jinja2
 import shutil
 import logging
 import random
+import math
 import itertools
 import networkx
-import matplotlib.pyplot as plt
 import argparse
 
 from subprocess import check_call
@@ -17,140 +17,267 @@ logger = logging.getLogger('generator')
 #logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.INFO)
 
-logging.debug('Parse argumetns')
-argparser = argparse.ArgumentParser(description='Generate docker-compose file and all required configuration for network using config.')
-argparser.add_argument('--recreate',
-    dest='recreate',
-    action='store_true',
-    help='Recreate configs from scratch, clean all')
-argparser.add_argument('--no-recreate',
-    dest='recreate',
-    action='store_false',
-    help='Save configs and just visualize current')
-argparser.add_argument('--clean',
-    dest='clean',
-    action='store_true',
-    help='Clean nodes artifacts')
-args = argparser.parse_args()
-
-swd = os.path.dirname(os.path.abspath(__file__))
-
-config_file = os.path.join(swd, "config.yml")
-node_config_file = os.path.join(swd, "node.conf.j2")
-dc_template_file = os.path.join(swd, "dc.yml.j2")
-node_temp_config_dest = os.path.join(swd, "node-configs")
-dc_outfile = os.path.join(swd, "docker-compose.yml")
-node_shared_artifacts_dir = os.path.normpath(os.path.join(swd, '..', 'artifacts'))
-
-logger.info("Read tool config")
-cfg = yaml.load(open(config_file), Loader=yaml.Loader)
-
-if args.recreate:
-    logger.info("Make dir for nodes config")
-    if os.path.exists(node_temp_config_dest):
-        shutil.rmtree(node_temp_config_dest)
-    os.makedirs(node_temp_config_dest)
-if args.recreate or args.clean:
-    logger.info("Clean artifacts dir")
-    if os.path.exists(node_shared_artifacts_dir):
-        check_call(['sudo', 'rm', '-rf', node_shared_artifacts_dir])
-    os.makedirs(node_shared_artifacts_dir)
-
-
-logger.debug("Load templates")
-with open(node_config_file, 'r') as f:
-    node_j2_cfg_template = jinja2.Template(f.read())
-with open(dc_template_file, 'r') as f:
-    dc_j2_template = jinja2.Template(f.read())
-
-networks = [f"network{nw_idx}" for nw_idx in range(cfg['networks count'])]
-gateways_count = [0] * cfg['networks count']
-nodes = []
-if args.recreate:
-    logger.info("Cook network")
+def make_nodes(cfg, configs_dir, rng=random):
+    # Networks of `network peers` pure nodes each, joined by gateways that sit
+    # in up to `max gateway connectivity` other networks. Returns the network
+    # names and the node configs (name, networks, cfgfile).
+    networks = [f"network{nw_idx}" for nw_idx in range(cfg['networks count'])]
+    gateways_count = [0] * cfg['networks count']
+    nodes = []
     for nw_idx in range(cfg['networks count']):
         logger.info(f"Work on {nw_idx} network")
         nw_name = networks[nw_idx]
-        networks.append(nw_name)
         logger.info(f"{nw_idx} | Make pure nodes")
         for n_idx in range(cfg['network peers']):
             n_name = f"nw{nw_idx}-n{n_idx}"
             nodes.append({
                 'name': n_name,
                 'networks': [nw_name],
-                'cfgfile': os.path.join(node_temp_config_dest, n_name)})
+                'cfgfile': os.path.join(configs_dir, n_name)})
         logger.info(f"{nw_idx} | Make gateways")
         # Check we need to make a new GW for current network
-        gws_count = random.randint(1, cfg['max gateways'])
+        gws_count = rng.randint(1, cfg['max gateways'])
         if gws_count <= gateways_count[nw_idx]:
             logger.info(f"{nw_idx} | Gateways already filled by others")
         else:
             other_nw_idxs = list(range(cfg['networks count']))
             other_nw_idxs.remove(nw_idx)
-            for gw_idx in range(random.randint(1, cfg['max gateways'])):
+            for gw_idx in range(rng.randint(1, cfg['max gateways'])):
                 gateways_count[nw_idx] += 1
                 gw_name = f"gw{len(nodes)}"
                 gw_networks = [nw_name]
-                gw_conn_cnt = random.randint(1, cfg['max gateway connectivity'])
+                gw_conn_cnt = rng.randint(1, cfg['max gateway connectivity'])
                 for _ in range(gw_conn_cnt):
                     # Here we need to select only "Free" networks, but it leads to parted graph
-                    oth_nw_idx = random.choice(other_nw_idxs)
+                    oth_nw_idx = rng.choice(other_nw_idxs)
                     other_nw_idxs.remove(oth_nw_idx)
                     gw_networks.append(networks[oth_nw_idx])
                     gateways_count[oth_nw_idx] += 1
                 nodes.append({
                     'name': gw_name,
                     'networks': gw_networks,
-                    'cfgfile': os.path.join(node_temp_config_dest, gw_name)})
-    logger.info(f"Made {len(nodes)} nodes to fulfill config")
+                    'cfgfile': os.path.join(configs_dir, gw_name)})
+    return networks, nodes
 
-    logger.debug("Write node configs")
-    for node in nodes:
-        output_text = node_j2_cfg_template.render(node)
-        with open(node['cfgfile'], 'w') as f:
-            f.write(output_text)
 
-else:
+def geometric_edges(count, radius, rng=random):
+    # Random geometric graph in the unit square, nodes closer than radius
+    # are linked. Points are bucketed into cells of side radius, so only
+    # the 3x3 neighborhood of every cell is compared.
+    points = [(rng.random(), rng.random()) for _ in range(count)]
+    cells = {}
+    for idx, (x, y) in enumerate(points):
+        cells.setdefault((int(x / radius), int(y / radius)), []).append(idx)
+    for (cx, cy), members in cells.items():
+        for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+            others = cells.get((cx + dx, cy + dy))
+            if not others:
+                continue
+            for u in members:
+                for v in others:
+                    if (dx, dy) == (0, 0) and v <= u:
+                        continue
+                    if math.dist(points[u], points[v]) <= radius:
+                        yield u, v
 
-    for n_cfg_fn in os.listdir(node_temp_config_dest):
-        with open(os.path.join(node_temp_config_dest, n_cfg_fn)) as n_cfg_f:
-            n_cfg = yaml.load(n_cfg_f, Loader=yaml.Loader)
-            n_cfg['cfgfile'] = os.path.join(node_temp_config_dest, n_cfg_fn)
-            nodes.append(n_cfg)
-    logger.info(f"Read {len(nodes)} node configs")
 
-logger.debug(f"(re)Dump docker-compose file '{dc_outfile}'")
+def scale_free_edges(count, attachments, rng=random):
+    # Barabasi-Albert preferential attachment
+    graph = networkx.barabasi_albert_graph(count, attachments, seed=rng.randrange(2 ** 32))
+    return graph.edges()
 
-with open(dc_outfile, 'w') as dc_file:
-    dc_file.write(dc_j2_template.render({
+
+def grid_edges(count):
+    # the smallest square grid holding count nodes, last row may be short
+    side = math.ceil(math.sqrt(count))
+    for idx in range(count):
+        if (idx + 1) % side and idx + 1 < count:
+            yield idx, idx + 1
+        if idx + side < count:
+            yield idx, idx + side
+
+
+def link_nodes(count, edges, configs_dir):
+    # Graph models have point-to-point links: every edge becomes a network
+    # of its own with the two nodes in it.
+    nodes = [{
+        'name': f"n{idx}",
+        'networks': [],
+        'cfgfile': os.path.join(configs_dir, f"n{idx}")} for idx in range(count)]
+    networks = []
+    for u, v in edges:
+        network = f"link{len(networks)}"
+        networks.append(network)
+        nodes[u]['networks'].append(network)
+        nodes[v]['networks'].append(network)
+    return networks, nodes
+
+
+MODELS = ('networks', 'geometric', 'scale-free', 'grid')
+
+
+def make_topology(cfg, configs_dir, rng=random):
+    # (networks, nodes) for the model named in cfg, 'networks' by default
+    model = cfg.get('model', 'networks')
+    if model == 'networks':
+        return make_nodes(cfg, configs_dir, rng)
+    count = cfg['nodes']
+    if model == 'geometric':
+        # radius for an expected degree of about `degree`
+        radius = cfg.get('radius') or math.sqrt(cfg.get('degree', 6) / (math.pi * count))
+        edges = geometric_edges(count, radius, rng)
+    elif model == 'scale-free':
+        edges = scale_free_edges(count, cfg.get('attachments', 2), rng)
+    elif model == 'grid':
+        edges = grid_edges(count)
+    else:
+        raise Exception(f'No graph model "{model}", expected one of {MODELS}')
+    return link_nodes(count, edges, configs_dir)
+
+
+def write_edges(path, nodes):
+    # Compact edge list for simulation and benchmark tooling: one
+    # "node node network" line per pair of nodes sharing a network,
+    # "node - network" for a node alone on its network and a bare "node"
+    # for a node without networks.
+    members = {}
+    with open(path, 'w') as f:
+        for node in nodes:
+            if not node['networks']:
+                f.write(f"{node['name']}\n")
+            for network in node['networks']:
+                members.setdefault(network, []).append(node['name'])
+        for network, names in members.items():
+            if len(names) == 1:
+                f.write(f"{names[0]} - {network}\n")
+            for u, v in itertools.combinations(names, 2):
+                f.write(f"{u} {v} {network}\n")
+
+
+if __name__ == '__main__':
+    logging.debug('Parse argumetns')
+    argparser = argparse.ArgumentParser(description='Generate docker-compose file and all required configuration for network using config.')
+    argparser.add_argument('--recreate',
+        dest='recreate',
+        action='store_true',
+        help='Recreate configs from scratch, clean all')
+    argparser.add_argument('--no-recreate',
+        dest='recreate',
+        action='store_false',
+        help='Save configs and just visualize current')
+    argparser.add_argument('--clean',
+        dest='clean',
+        action='store_true',
+        help='Clean nodes artifacts')
+    argparser.add_argument('--model',
+        choices=MODELS,
+        help='Graph model, overrides "model" from config')
+    argparser.add_argument('--nodes',
+        type=int,
+        help='Node count for graph models, overrides "nodes" from config')
+    argparser.add_argument('--seed',
+        type=int,
+        help='Random seed, overrides "seed" from config')
+    argparser.add_argument('--no-visualize',
+        dest='visualize',
+        action='store_false',
+        help='Do not draw the network, drawing is skipped anyway above "visualize limit" nodes')
+    args = argparser.parse_args()
+
+    swd = os.path.dirname(os.path.abspath(__file__))
+
+    config_file = os.path.join(swd, "config.yml")
+    node_config_file = os.path.join(swd, "node.conf.j2")
+    dc_template_file = os.path.join(swd, "dc.yml.j2")
+    node_temp_config_dest = os.path.join(swd, "node-configs")
+    dc_outfile = os.path.join(swd, "docker-compose.yml")
+    node_shared_artifacts_dir = os.path.normpath(os.path.join(swd, '..', 'artifacts'))
+
+    logger.info("Read tool config")
+    cfg = yaml.load(open(config_file), Loader=yaml.Loader)
+    for key in ('model', 'nodes', 'seed'):
+        if getattr(args, key) is not None:
+            cfg[key] = getattr(args, key)
+
+    if args.recreate:
+        logger.info("Make dir for nodes config")
+        if os.path.exists(node_temp_config_dest):
+            shutil.rmtree(node_temp_config_dest)
+        os.makedirs(node_temp_config_dest)
+    if args.recreate or args.clean:
+        logger.info("Clean artifacts dir")
+        if os.path.exists(node_shared_artifacts_dir):
+            check_call(['sudo', 'rm', '-rf', node_shared_artifacts_dir])
+        os.makedirs(node_shared_artifacts_dir)
+
+
+    logger.debug("Load templates")
+    with open(node_config_file, 'r') as f:
+        node_j2_cfg_template = jinja2.Template(f.read())
+    with open(dc_template_file, 'r') as f:
+        dc_j2_template = jinja2.Template(f.read())
+
+    edges_outfile = os.path.join(swd, "topology.edges")
+    nodes = []
+    if args.recreate:
+        logger.info("Cook network")
+        networks, nodes = make_topology(cfg, node_temp_config_dest, random.Random(cfg.get('seed')))
+        logger.info(f"Made {len(nodes)} nodes to fulfill config")
+
+        logger.debug("Write node configs")
+        for node in nodes:
+            node_j2_cfg_template.stream(node).dump(node['cfgfile'])
+        write_edges(edges_outfile, nodes)
+
+    else:
+
+        for n_cfg_fn in os.listdir(node_temp_config_dest):
+            with open(os.path.join(node_temp_config_dest, n_cfg_fn)) as n_cfg_f:
+                n_cfg = yaml.load(n_cfg_f, Loader=yaml.Loader)
+                n_cfg['cfgfile'] = os.path.join(node_temp_config_dest, n_cfg_fn)
+                nodes.append(n_cfg)
+        networks = list(dict.fromkeys(nw for n in nodes for nw in n['networks']))
+        logger.info(f"Read {len(nodes)} node configs")
+
+    logger.debug(f"(re)Dump docker-compose file '{dc_outfile}'")
+
+    # streamed to the file while rendering, services one by one
+    dc_j2_template.stream({
         'networks': networks,
         'nodes': nodes,
         'node_shared_artifacts_dir': node_shared_artifacts_dir
-    }))
-
-logger.info("Visualize network just made")
-
-edges = []
-for nw_name in networks:
-    nw_node_names = [n['name'] for n in nodes if nw_name in n['networks']]
-    edges += list(itertools.combinations(nw_node_names, 2))
-G = networkx.Graph()
-G.add_edges_from(edges)
-
-plt.clf()
-plt.plot()
-plt.axis('off')
-networkx.draw(
-    G,
-    pos = networkx.nx_pydot.graphviz_layout(G),
-    node_size=150,
-    node_color='lightblue',
-    linewidths=1,
-    font_size=10,
-    font_weight='bold', with_labels=True)
-# networkx.draw_spring(G, with_labels=True)
-image_name = os.path.join(swd, 'network-graph.png')
-plt.savefig(image_name)
-
-logger.info(f"Made networks {networks}")
-logger.info("Done")
\ No newline at end of file
+    }).dump(dc_outfile)
+
+    if not args.visualize or len(nodes) > cfg.get('visualize limit', 500):
+        logger.info(f"Skip visualization of {len(nodes)} nodes")
+    else:
+        logger.info("Visualize network just made")
+        import matplotlib.pyplot as plt
+
+        members = {}
+        for n in nodes:
+            for nw_name in n['networks']:
+                members.setdefault(nw_name, []).append(n['name'])
+        edges = []
+        for nw_node_names in members.values():
+            edges += list(itertools.combinations(nw_node_names, 2))
+        G = networkx.Graph()
+        G.add_edges_from(edges)
+
+        plt.clf()
+        plt.plot()
+        plt.axis('off')
+        networkx.draw(
+            G,
+            pos = networkx.nx_pydot.graphviz_layout(G),
+            node_size=150,
+            node_color='lightblue',
+            linewidths=1,
+            font_size=10,
+            font_weight='bold', with_labels=True)
+        # networkx.draw_spring(G, with_labels=True)
+        image_name = os.path.join(swd, 'network-graph.png')
+        plt.savefig(image_name)
+
+    logger.info(f"Made {len(networks)} networks")
+    logger.info("Done")
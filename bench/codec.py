@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Compare the binary wire format in node/message.py with the pickle encoding
+# it replaced: datagram size and encode/decode time for HELLO, TC and CUSTOM.
+# The codec is pure Python and stays slower than pickle's C implementation:
+# about 2x to encode and 1.3x to decode a HELLO/TC of 128 entries, 2-3x for
+# small messages where fixed costs dominate. What it buys is a datagram 2-3x
+# smaller and not unpickling whatever arrives on the network.
+
+import os
+import sys
+import pickle
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'node'))
+import message
+
+
+def make_messages(neighbors):
+    handler = message.MessageHandler()
+    table = [{
+        'name': f'nw{i // 10}-n{i % 10}',
+        'addr': [f'10.0.{i // 250}.{i % 250 + 1}'],
+        'local_mpr': i % 7 == 0,
+        'mprss': i % 5 == 0} for i in range(neighbors)]
+    custom = handler.custom_message('nw0-n0', f'nw{neighbors}-n0', 'Hello, friend!')
+    custom.forwarders += [x['name'] for x in table[:8]]
+    return {
+        'HELLO': handler.hello_message('nw0-n0', table),
+        'TC': handler.tc_message('gw1', [{'name': x['name'], 'addr': x['addr']} for x in table]),
+        'CUSTOM': custom,
+    }
+
+
+def best(fn, number, repeat=5):
+    # best of repeat, in microseconds per call
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e6
+
+
+def bench(msg, number):
+    encoded = msg.make()
+    pickled = pickle.dumps(msg)
+    return {
+        'codec size': len(encoded),
+        'pickle size': len(pickled),
+        'codec enc us': best(msg.make, number),
+        'pickle enc us': best(lambda: pickle.dumps(msg), number),
+        'codec dec us': best(lambda: message.Codec.decode(encoded), number),
+        'pickle dec us': best(lambda: pickle.loads(pickled), number),
+    }
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark message codec against pickle.')
+    argparser.add_argument('--neighbors', type=int, nargs='+', default=[4, 32, 128, 512])
+    argparser.add_argument('--number', type=int, default=1000)
+    args = argparser.parse_args()
+
+    columns = ['codec size', 'pickle size', 'codec enc us', 'pickle enc us', 'codec dec us', 'pickle dec us']
+    print(f'{"message":<14}' + ''.join(f'{c:>15}' for c in columns))
+    for neighbors in args.neighbors:
+        for message_type, msg in make_messages(neighbors).items():
+            result = bench(msg, args.number)
+            print(f'{message_type + "/" + str(neighbors):<14}' + ''.join(f'{result[c]:>15.1f}' for c in columns))
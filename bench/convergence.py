@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Convergence of a whole mesh: how long after start, a link failure, a link
+# coming back or a node joining every node has the right 1-hop/2-hop view
+# and MPRs among its true 1-hop neighbors that cover every true strict
+# 2-hop neighbor. The ground truth comes from the mesh membership alone, it
+# never asks the node code what it would select. The mesh described
+# by an autogen/config.yml-style file runs on the simulated mesh in virtual
+# time; nodes emit on their own jittered schedule (or, with --adaptive, on
+# the adaptive schedule of their own Scheduler), every tick of virtual time
+# each node is checked against the ground truth.
+
+import os
+import sys
+import yaml
+import random
+import logging
+import argparse
+
+swd = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(swd, '..', 'node'))
+sys.path.insert(0, os.path.join(swd, '..', 'autogen'))
+from generator import make_nodes
+from simulation import Simulation
+
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))]
+
+
+class Harness:
+    def __init__(self, cfg, seed=1, tick=1.0, adaptive=False, **overrides):
+        self.rng = random.Random(seed)
+        self.tick = tick
+        self.adaptive = adaptive
+        logger = logging.getLogger('convergence')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        _, nodes = make_nodes(cfg, '', self.rng)
+        self.sim = Simulation([], logger=logger, adaptive_intervals=adaptive, **overrides)
+        self.mesh = self.sim.mesh
+        self.membership = {}  # node -> {iface: network}, links that are up
+        self.down = []  # (node, iface, network) taken down and not restored yet
+        self.phase = {}  # node -> offset of its emission within the period
+        self.now = 0.0
+        self.events = []
+        for x in nodes:
+            self.join(x['name'], x['networks'])
+
+    # ground truth
+
+    def truth(self):
+        members = {}
+        for node, links in self.membership.items():
+            for network in links.values():
+                members.setdefault(network, set()).add(node)
+        adj = {node: set() for node in self.membership}
+        for nodes in members.values():
+            for node in nodes:
+                adj[node] |= nodes - {node}
+        expected = {}
+        for node, one in adj.items():
+            two = set().union(*(adj[x] for x in one)) - one - {node} if one else set()
+            expected[node] = (one, two, adj)
+        return expected
+
+    def correct(self, name, expected):
+        node = self.sim.nodes[name]
+        one, two, adj = expected
+        mprs = set(node.get_by('local_mpr'))
+        covered = set().union(*(adj[x] for x in mprs)) if mprs <= one else set()
+        return (set(node.get_neighbors(dist=1)) == one
+                and set(node.get_neighbors(dist=2)) == two
+                and mprs <= one and two <= covered)
+
+    # changes
+
+    def join(self, name, networks):
+        node = self.sim.add_node({'name': name, 'networks': networks, 'jitter_seed': self.rng.random()})
+        self.membership[name] = dict(node.transport.networks)
+        self.phase[name] = self.rng.uniform(0, node.broadcast_sleep)
+
+    def link_down(self):
+        name = self.rng.choice(sorted(x for x, links in self.membership.items() if links))
+        iface = self.rng.choice(sorted(self.membership[name]))
+        network = self.mesh.link_down(self.sim.nodes[name].transport, iface)
+        del self.membership[name][iface]
+        self.down.append((name, iface, network))
+        return f'{name}/{iface} down'
+
+    def link_up(self):
+        name, iface, network = self.down.pop(self.rng.randrange(len(self.down)))
+        self.mesh.link_up(self.sim.nodes[name].transport, iface, network)
+        self.membership[name][iface] = network
+        return f'{name}/{iface} up'
+
+    def node_join(self):
+        network = self.rng.choice(sorted({n for links in self.membership.values() for n in links.values()}))
+        name = f'join{len(self.events)}'
+        self.join(name, [network])
+        return f'{name} joins {network}'
+
+    # driving
+
+    def step(self):
+        self.now += self.tick
+        self.mesh.now = self.now
+        for name, node in list(self.sim.nodes.items()):
+            if self.adaptive:
+                # expiry, emission and retransmits as on a live node
+                node.scheduler.run()
+                continue
+            node.expire()
+            period = node.broadcast_sleep
+            if (self.now - self.phase[name]) % period < self.tick:
+                node.emit()
+        self.mesh.run()
+
+    def observe(self, label, duration):
+        # run for duration seconds after a change, per node time of the last
+        # transition to a correct state (None if still wrong at the end)
+        expected = self.truth()
+        started = self.now
+        delivered, sent = self.mesh.delivered, self.mesh.bytes
+        converged = {x: (0.0 if self.correct(x, e) else None) for x, e in expected.items()}
+        affected = {x for x, t in converged.items() if t is None}
+        while self.now - started < duration:
+            self.step()
+            for name, e in expected.items():
+                ok = self.correct(name, e)
+                if ok and converged[name] is None:
+                    converged[name] = self.now - started
+                    affected.add(name)
+                elif not ok:
+                    converged[name] = None
+                    affected.add(name)
+        times = [converged[x] for x in affected if converged[x] is not None]
+        event = {
+            'event': label,
+            'at': started,
+            'nodes': len(expected),
+            'affected': len(affected),
+            'unconverged': sum(1 for x in affected if converged[x] is None),
+            'p50': percentile(times, 50),
+            'p99': percentile(times, 99),
+            'max': max(times) if times else None,
+            'datagrams': self.mesh.delivered - delivered,
+            'bytes': self.mesh.bytes - sent,
+            'times': times,
+        }
+        self.events.append(event)
+        return event
+
+    def run(self, events, duration):
+        yield self.observe('start', duration)
+        for idx in range(events):
+            kind = ('down', 'up', 'join')[idx % 3]
+            if kind == 'up' and not self.down:
+                kind = 'join'
+            label = {'down': self.link_down, 'up': self.link_up, 'join': self.node_join}[kind]()
+            yield self.observe(label, duration)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Measure mesh convergence after start and topology changes.')
+    argparser.add_argument('--config', default=os.path.join(swd, '..', 'autogen', 'config.yml'),
+                           help='Network description in autogen/config.yml format')
+    argparser.add_argument('--seed', type=int, default=1)
+    argparser.add_argument('--events', type=int, default=6, help='Link failures, restores and joins to inject')
+    argparser.add_argument('--duration', type=float, default=300, help='Virtual seconds observed per event')
+    argparser.add_argument('--tick', type=float, default=1.0)
+    argparser.add_argument('--broadcast-sleep', type=float, default=30)
+    argparser.add_argument('--full-snapshot-every', type=int, default=5)
+    argparser.add_argument('--adaptive', action='store_true', help='Emit on the adaptive node schedule')
+    argparser.add_argument('--min-interval', type=float, default=2)
+    argparser.add_argument('--max-interval', type=float, help='broadcast sleep by default')
+    args = argparser.parse_args()
+
+    cfg = yaml.load(open(args.config), Loader=yaml.Loader)
+    harness = Harness(cfg, seed=args.seed, tick=args.tick, adaptive=args.adaptive,
+                      broadcast_sleep=args.broadcast_sleep, full_snapshot_every=args.full_snapshot_every,
+                      min_interval=args.min_interval, max_interval=args.max_interval or args.broadcast_sleep)
+
+    def fmt(x):
+        return f'{x:>8.0f}' if x is not None else f'{"-":>8}'
+
+    print(f'{"event":<28}{"nodes":>7}{"affected":>9}{"open":>6}{"p50 s":>8}{"p99 s":>8}{"max s":>8}{"datagrams":>11}{"bytes":>11}')
+    for e in harness.run(args.events, args.duration):
+        print(f'{e["event"]:<28}{e["nodes"]:>7}{e["affected"]:>9}{e["unconverged"]:>6}'
+              f'{fmt(e["p50"])}{fmt(e["p99"])}{fmt(e["max"])}{e["datagrams"]:>11}{e["bytes"]:>11}')
+    # per-node convergence times after changes, start excluded
+    times = [t for e in harness.events[1:] for t in e['times']]
+    print(f'changes: p50 {percentile(times, 50)}s, p99 {percentile(times, 99)}s over {len(times)} node convergences, '
+          f'{sum(e["unconverged"] for e in harness.events)} never converged')
+    print(f'overhead: {harness.mesh.delivered / harness.now / len(harness.sim.nodes):.2f} datagrams/s and '
+          f'{harness.mesh.bytes / harness.now / len(harness.sim.nodes):.0f} B/s received per node')
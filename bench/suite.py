@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# Node hot paths on synthetic meshes of increasing size, built with the
+# network/gateway model of autogen/generator.py and converged in-process on
+# the simulated mesh (no sockets). Results are stored and compared relative
+# to a pure-Python reference workload measured in the same run, so the
+# baseline carries over between machines; --save replaces it.
+
+import os
+import sys
+import json
+import random
+import timeit
+import logging
+import argparse
+
+swd = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(swd, '..', 'node'))
+sys.path.insert(0, os.path.join(swd, '..', 'autogen'))
+import message
+from generator import make_nodes
+from simulation import Simulation
+from transport import SimulatedMesh
+
+BASELINE = os.path.join(swd, 'baseline.json')
+# cases faster than this are reported but never checked, timer noise
+# dominates below it
+FLOOR_US = 2.0
+
+
+def build(networks, peers, max_gateways, connectivity, seed, store):
+    cfg = {
+        'networks count': networks,
+        'network peers': peers,
+        'max gateways': max_gateways,
+        'max gateway connectivity': connectivity}
+    _, nodes = make_nodes(cfg, '', random.Random(seed))
+    return converge([{'name': x['name'], 'networks': x['networks']} for x in nodes], store)
+
+
+def converge(configs, store):
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    sim = Simulation(configs, logger=logger, topology_store=store)
+    # the busiest gateway, rounds until its view stops growing
+    node = max(sim.nodes.values(), key=lambda x: (len(x.network), x.name))
+    known, stable = 0, 0
+    while stable < 2:
+        sim.round()
+        stable = stable + 1 if len(node.network_graph) == known else 0
+        known = len(node.network_graph)
+    return sim, node
+
+
+def measure(fn, repeat=5):
+    # best of repeat, in microseconds per call
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def measure_relative(fn, ref, repeat=5):
+    # (us, multiple of ref): both best of repeat, timed alternately so that
+    # load changes during the run hit both alike
+    timers = [timeit.Timer(fn), timeit.Timer(ref)]
+    numbers = [x.autorange()[0] for x in timers]
+    best = [float('inf'), float('inf')]
+    for _ in range(repeat):
+        for idx, timer in enumerate(timers):
+            best[idx] = min(best[idx], timer.timeit(numbers[idx]) / numbers[idx])
+    return best[0] * 1e6, best[0] / best[1]
+
+
+def reference():
+    # interpreter speed yardstick: BFS over a 20x20 grid of dicts and sets,
+    # the same kind of work as the topology code
+    side = 20
+    adj = {(x, y): {(x + dx, y + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                    if 0 <= x + dx < side and 0 <= y + dy < side}
+           for x in range(side) for y in range(side)}
+
+    def bfs():
+        seen, frontier = {(0, 0): 0}, [(0, 0)]
+        while frontier:
+            layer = []
+            for node in frontier:
+                for nbr in adj[node]:
+                    if nbr not in seen:
+                        seen[nbr] = seen[node] + 1
+                        layer.append(nbr)
+            frontier = layer
+        return seen
+    return bfs
+
+
+def cases(sim, node):
+    far = max(node.network_graph, key=lambda x: len(node.get_route(x)))
+    nbr = node.get_neighbors()[0]
+    own = message.MessageHandler().hello_message(node.name, node.neighbor_table)
+    own.seq = 1
+    encoded = own.make()
+    # a full HELLO of a neighbor, as received, and the same with one
+    # 2-hop link toggled, to have an update that moves the MPR set
+    hello = message.MessageHandler().hello_message(
+        nbr, [{'name': x, 'addr': []} for x in node.network_graph.neighbors(nbr)], addr=None)
+    hello_changed = message.MessageHandler().hello_message(
+        nbr, [{'name': x['name'], 'addr': []} for x in hello.neighbors[:-1]], addr=None)
+    addr = node.get_data(nbr)['addr'][0]
+    datagrams = [hello.make(), hello_changed.make()]
+    toggle = [0]
+
+    def update_MPRs():
+        node.mpr_selector.dirty = True
+        node.update_MPRs()
+
+    def get_neighbors_cold():
+        node.distances.invalidate()
+        node.get_neighbors(dist=2)
+
+    def get_route_cold():
+        node.distances.invalidate()
+        node.get_route(far)
+
+    def update_topology_changed():
+        toggle[0] ^= 1
+        node.__update_topology__(datagrams[toggle[0]], addr)
+
+    return {
+        'update_MPRs': update_MPRs,
+        'get_neighbors(2) cold': get_neighbors_cold,
+        'get_neighbors(2)': lambda: node.get_neighbors(dist=2),
+        'get_route cold': get_route_cold,
+        'get_route': lambda: node.get_route(far),
+        'get_by(mprss)': lambda: node.get_by('mprss'),
+        'get_by(mpr)': lambda: node.get_by('mpr'),
+        'pack HELLO': own.make,
+        'unpack HELLO': lambda: message.MessageHandler().unpack(encoded),
+        'update_topology same': lambda: node.__update_topology__(datagrams[0], addr),
+        'update_topology changed': update_topology_changed,
+    }
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark node operations on generated topologies.')
+    argparser.add_argument('--networks', type=int, nargs='+', default=[10, 20, 40, 80])
+    argparser.add_argument('--peers', type=int, default=4)
+    argparser.add_argument('--max-gateways', type=int, default=2)
+    argparser.add_argument('--connectivity', type=int, default=3)
+    argparser.add_argument('--seed', type=int, default=1)
+    argparser.add_argument('--edges', help='Benchmark a topology.edges file of autogen/generator.py instead')
+    argparser.add_argument('--store', default='networkx')
+    argparser.add_argument('--save', action='store_true', help='Store the results as the new baseline')
+    argparser.add_argument('--tolerance', type=float, default=1.5,
+                           help='Slowdown against the baseline reported as a regression')
+    argparser.add_argument('--strict', action='store_true',
+                           help='Exit non-zero on regressions, only meaningful on a quiet machine')
+    args = argparser.parse_args()
+
+    # baseline values are multiples of the reference workload
+    baseline = json.load(open(BASELINE)) if os.path.exists(BASELINE) else {}
+    results = {}
+    regressions = []
+    ref = reference()
+    print(f'reference {measure(ref):.1f}us, relative times are multiples of it')
+    print(f'{"case":<32}{"nodes":>8}{"us":>12}{"relative":>10}{"baseline":>10}{"ratio":>8}')
+    if args.edges:
+        topologies = [(os.path.basename(args.edges), lambda: converge(SimulatedMesh.load_edges(args.edges), args.store))]
+    else:
+        topologies = [(networks, lambda networks=networks: build(
+            networks, args.peers, args.max_gateways, args.connectivity, args.seed, args.store))
+            for networks in args.networks]
+    for networks, make in topologies:
+        sim, node = make()
+        for name, fn in cases(sim, node).items():
+            key = f'{args.store}/{networks}/{name}'
+            us, relative = measure_relative(fn, ref)
+            base = baseline.get(key)
+            checked = base is not None and us >= FLOOR_US
+            if checked and relative / base > args.tolerance:
+                # confirm with a second measurement before calling it a regression
+                us, again = measure_relative(fn, ref)
+                relative = min(relative, again)
+            results[key] = relative
+            ratio = relative / base if checked else None
+            if ratio and ratio > args.tolerance:
+                regressions.append(key)
+            print(f'{name:<32}{len(node.network_graph):>8}{us:>12.1f}{relative:>10.4f}'
+                  + (f'{base:>10.4f}' if base is not None else f'{"-":>10}')
+                  + (f'{ratio:>8.2f}' if ratio else f'{"-":>8}')
+                  + (' !' if key in regressions else ''))
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+    if regressions:
+        print(f'{len(regressions)} regressions over x{args.tolerance}: {", ".join(regressions)}')
+        if args.strict:
+            exit(1)
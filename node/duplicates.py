@@ -0,0 +1,41 @@
+import time
+from collections import OrderedDict, Counter
+
+
+class DuplicateSet:
+    # OLSR duplicate set: (originator, type, seq) of every message already
+    # processed or forwarded, kept for hold_time seconds. Entries are stored
+    # in arrival order, so with a constant hold time the oldest ones expire
+    # first and eviction only ever looks at the head. max_size bounds memory
+    # when a flood outpaces the hold time.
+    def __init__(self, hold_time=30, max_size=65536, clock=time.monotonic):
+        self.hold_time = hold_time
+        self.max_size = max_size
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> expiry time
+        self.suppressed = Counter()  # message type -> duplicates dropped
+
+    def __expire__(self, now):
+        while self.entries:
+            key, expires = next(iter(self.entries.items()))
+            if expires > now and len(self.entries) <= self.max_size:
+                break
+            self.entries.popitem(last=False)
+
+    def add(self, originator, message_type, seq):
+        now = self.clock()
+        self.__expire__(now)
+        self.entries[(originator, message_type, seq)] = now + self.hold_time
+        self.entries.move_to_end((originator, message_type, seq))
+
+    def check(self, originator, message_type, seq):
+        # True if the message was seen already (and counts it as suppressed),
+        # otherwise records it and returns False
+        now = self.clock()
+        self.__expire__(now)
+        key = (originator, message_type, seq)
+        if key in self.entries:
+            self.suppressed[message_type] += 1
+            return True
+        self.entries[key] = now + self.hold_time
+        return False
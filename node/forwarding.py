@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict, Counter
+
+
+class RetransmitQueue:
+    # Unicast CUSTOM messages sent to a next hop and not acknowledged yet,
+    # keyed by (originator, seq). Entries are kept in send order; a full
+    # queue evicts the oldest one, so memory stays bounded when a next hop
+    # goes silent. due() hands back the entries whose ACK timed out and
+    # gives up on an entry after max_retries resends.
+    def __init__(self, timeout=1.0, max_retries=3, max_size=256, clock=time.monotonic):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_size = max_size
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> [hop, ifaces, data, retries, deadline]
+        self.dropped = Counter()  # reason -> entries given up on
+
+    def add(self, key, hop, ifaces, data):
+        self.entries.pop(key, None)
+        while len(self.entries) >= self.max_size:
+            self.entries.popitem(last=False)
+            self.dropped['evicted'] += 1
+        self.entries[key] = [hop, ifaces, data, 0, self.clock() + self.timeout]
+
+    def ack(self, key, hop):
+        # True if it was waiting for exactly this hop
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != hop:
+            return False
+        del self.entries[key]
+        return True
+
+    def due(self):
+        # [(key, hop, ifaces, data)] to send again now
+        now = self.clock()
+        resend = []
+        for key, entry in list(self.entries.items()):
+            if entry[4] > now:
+                continue
+            if entry[3] >= self.max_retries:
+                del self.entries[key]
+                self.dropped['retries'] += 1
+                continue
+            entry[3] += 1
+            entry[4] = now + self.timeout
+            resend.append((key, entry[0], entry[1], entry[2]))
+        return resend
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,215 @@
+import time
+import threading
+from collections import deque, Counter, OrderedDict
+from message import Codec
+from packet import Packet
+
+
+class IngressQueue:
+    # Bounded receive queue with one FIFO per priority class. Datagrams are
+    # split into their messages on arrival and each message is queued by its
+    # type (from the header and names table, nothing is decoded), so a CUSTOM
+    # storm cannot delay the HELLOs that keep links alive. Taking always
+    # empties HELLO before TC and TC before everything else.
+    #
+    # Overload, per class:
+    #   rate limit  a token bucket per (sender address, class), messages over
+    #               it are dropped before they take any room
+    #   coalesce    (HELLO/TC) a full snapshot replaces the messages of the
+    #               same originator and type still queued; nothing else is
+    #               ever dropped from the queue, as later deltas are based
+    #               on it. Arrivals that do not fit are dropped.
+    #   drop_tail   arrivals that do not fit are dropped
+    #   queue full  the arriving message sheds the newest queued message of
+    #               a lower drop_tail class, or is dropped if there is none
+    PRIORITIES = ('HELLO', 'TC', 'CUSTOM')  # anything else is served as CUSTOM
+    POLICIES = {'HELLO': 'coalesce', 'TC': 'coalesce', 'CUSTOM': 'drop_tail'}
+    RATES = {'HELLO': (5, 10), 'TC': (1000, 2000), 'CUSTOM': (20, 40)}  # (messages/s, burst) per sender
+
+    def __init__(self, maxsize=1024, sizes=None, policies=None, rates=None, max_senders=4096, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.sizes = {x: maxsize for x in self.PRIORITIES}
+        self.sizes.update(sizes or {})
+        self.policies = dict(self.POLICIES)
+        self.policies.update(policies or {})
+        self.rates = dict(self.RATES)
+        self.rates.update(rates or {})  # None for a class disables its limit
+        self.max_senders = max_senders
+        self.clock = clock
+        # items are [data, addr, iface, coalescing key], data None once
+        # coalesced away; counts hold the live ones only
+        self.queues = {x: deque() for x in self.PRIORITIES}
+        self.counts = Counter()
+        self.pending = {}  # (type, originator) -> deque of its live items
+        self.buckets = OrderedDict()  # (addr, class) -> [tokens, last refill], least recent first
+        self.dropped = Counter()  # (class, reason) -> messages
+        self.size = 0
+        self.cond = threading.Condition()
+
+    def classify(self, msg):
+        name = Codec.TYPE_NAMES.get(msg[2]) if len(msg) > 2 and msg[0] == Codec.MAGIC else None
+        return name if name in self.queues else 'CUSTOM'
+
+    def __allow__(self, addr, kind, now):
+        rate = self.rates.get(kind)
+        if not rate:
+            return True
+        key = (addr, kind)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_senders:
+                self.buckets.popitem(last=False)
+            bucket = self.buckets[key] = [rate[1], now]
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(rate[1], bucket[0] + (now - bucket[1]) * rate[0])
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def __coalesce__(self, kind, key):
+        for item in self.pending.pop(key, ()):
+            item[0] = None
+            self.counts[kind] -= 1
+            self.size -= 1
+            self.dropped[kind, 'coalesced'] += 1
+        fifo = self.queues[kind]
+        if len(fifo) > 2 * self.sizes[kind]:
+            # do not let replaced items pile up while the worker lags
+            self.queues[kind] = deque(x for x in fifo if x[0] is not None)
+
+    def __shed__(self, kind):
+        # drop the newest message of the lowest drop_tail class below kind
+        for lower in reversed(self.PRIORITIES[self.PRIORITIES.index(kind) + 1:]):
+            if self.policies[lower] != 'drop_tail' or not self.counts[lower]:
+                continue
+            fifo = self.queues[lower]
+            while fifo[-1][0] is None:
+                fifo.pop()
+            fifo.pop()
+            self.counts[lower] -= 1
+            self.size -= 1
+            self.dropped[lower, 'shed'] += 1
+            return True
+        return False
+
+    def __enqueue__(self, kind, item):
+        if self.counts[kind] >= self.sizes[kind] or (self.size >= self.maxsize and not self.__shed__(kind)):
+            self.dropped[kind, 'full'] += 1
+            return False
+        self.queues[kind].append(item)
+        if item[3]:
+            self.pending.setdefault(item[3], deque()).append(item)
+        self.counts[kind] += 1
+        self.size += 1
+        return True
+
+    def put(self, data, addr, iface=None):
+        # returns how many of the datagram's messages were queued
+        try:
+            messages = Packet.split(data)
+        except Exception:
+            self.dropped['unknown', 'malformed'] += 1
+            return 0
+        queued = 0
+        with self.cond:
+            now = self.clock()
+            for msg in messages:
+                kind = self.classify(msg)
+                if not self.__allow__(addr, kind, now):
+                    self.dropped[kind, 'rate'] += 1
+                    continue
+                key = None
+                if self.policies[kind] == 'coalesce':
+                    try:
+                        _, sender, full = Codec.peek(msg)
+                    except Exception:
+                        self.dropped[kind, 'malformed'] += 1
+                        continue
+                    key = (kind, sender)
+                    if full:
+                        self.__coalesce__(kind, key)
+                if self.__enqueue__(kind, [bytes(msg), addr, iface, key]):
+                    queued += 1
+            if queued:
+                self.cond.notify()
+        return queued
+
+    def take(self, count):
+        # up to count messages by priority, without waiting
+        batch = []
+        with self.cond:
+            for kind in self.PRIORITIES:
+                fifo = self.queues[kind]
+                while fifo and len(batch) < count:
+                    item = fifo.popleft()
+                    if item[0] is None:
+                        continue
+                    if item[3]:
+                        pending = self.pending[item[3]]
+                        pending.popleft()
+                        if not pending:
+                            del self.pending[item[3]]
+                    self.counts[kind] -= 1
+                    batch.append(tuple(item[:3]))
+            self.size -= len(batch)
+        return batch
+
+    def wait(self, timeout=None):
+        # until something is queued, False on timeout
+        with self.cond:
+            return self.cond.wait_for(lambda: self.size, timeout)
+
+    def qsize(self, kind=None):
+        return self.counts[kind] if kind else self.size
+
+    def empty(self):
+        return not self.size
+
+
+class UpdateWorker:
+    # Decouples packet receive from topology updates. Receivers only put raw
+    # datagrams on the IngressQueue; one worker thread waits for the first
+    # message, lets the debounce window collect more, then hands everything
+    # queued (up to max_batch, highest priority first) to apply_batch in one
+    # call. Overload drops messages instead of blocking the receiver.
+    def __init__(self, apply_batch, maxsize=1024, debounce=0.05, max_batch=256, logger=None, **ingress):
+        # ingress: sizes, policies, rates, see IngressQueue
+        self.apply_batch = apply_batch
+        self.queue = IngressQueue(maxsize, **ingress)
+        self.debounce = debounce
+        self.max_batch = max_batch
+        self.logger = logger
+        self.batches = 0
+        self.applied = 0
+        self.thread = None
+
+    @property
+    def dropped(self):
+        return sum(self.queue.dropped.values())
+
+    def put(self, data, addr, iface=None):
+        return self.queue.put(data, addr, iface) > 0
+
+    def __apply__(self, batch):
+        try:
+            self.apply_batch(batch)
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f'Update batch of {len(batch)} failed: {e}')
+        self.batches += 1
+        self.applied += len(batch)
+
+    def run(self):
+        while True:
+            self.queue.wait()
+            if self.debounce:
+                time.sleep(self.debounce)
+            self.__apply__(self.queue.take(self.max_batch))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='update_worker', daemon=True)
+        self.thread.start()
+        return self.thread
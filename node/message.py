@@ -1,6 +1,10 @@
-import pickle
 import json
 import copy
+import struct
+import socket
+from itertools import chain, accumulate
+from operator import itemgetter
+from collections import deque
 
 # Узлы сети с заданным интервалом транслируют HELLO-сообщение, в которых содержится:
 # * собственный адрес узла,
@@ -11,7 +15,7 @@ import copy
 # * информация о соединении абонента с одношаговыми соседями.
 
 class Message:
-    MESSAGE_TYPES = ['HELLO', 'TC', 'CUSTOM', 'ALERT']
+    MESSAGE_TYPES = ['HELLO', 'TC', 'CUSTOM', 'ALERT', 'ACK']
 
     @classmethod
     def from_type(cls, message_type, **args):
@@ -25,52 +29,403 @@ class Message:
         return json.dumps(self.__dict__)
 
     def make(self):
-        return pickle.dumps(self)
+        return Codec.encode(self)
 
 class HelloMessage(Message):
-    def __init__(self, sender, neighbor_table, addr=None):
+    def __init__(self, sender, neighbor_table, addr=None, seq=0, ansn=0, base_ansn=None, removed=None):
+        self.seq = seq
         self.message_type = 'HELLO'
         self.sender = sender
         self.addr = addr
         self.neighbors = neighbor_table
+        # base_ansn is None for a full snapshot, otherwise neighbors/removed
+        # are the delta turning advertised set base_ansn into ansn
+        self.ansn = ansn
+        self.base_ansn = base_ansn
+        self.removed = removed if removed else []
 
     def __str__(self):
         return f'TYPE: {self.message_type}; SENDER: {self.sender}; ADDR: {self.addr}; NEIGHBORS: {self.neighbors}'
 
 class TcMessage(Message):
-    def __init__(self, sender, mpr_set, addr=None):
+    def __init__(self, sender, mpr_set, addr=None, seq=0, ansn=0, base_ansn=None, removed=None):
+        self.seq = seq
         self.message_type = 'TC'
         self.sender = sender
         self.addr = addr
         self.mpr_set = mpr_set
+        self.ansn = ansn
+        self.base_ansn = base_ansn
+        self.removed = removed if removed else []
 
     def __str__(self):
         return f'TYPE: {self.message_type}; SENDER: {self.sender}; MPR SET: {self.mpr_set}'
 
 class CustomMessage(Message):
-    def __init__(self, sender, dest, msg, addr=None):
+    def __init__(self, sender, dest, msg, addr=None, seq=0, hop=None, route=None, ack=False):
+        self.seq = seq
         self.message_type = 'CUSTOM'
         self.sender = sender
         self.addr = addr
         self.dest = dest
         self.msg = msg
         self.forwarders=[sender]
+        # hop is the only node that may forward it (None: flooded by MPRs),
+        # route a source route sender..dest, ack asks every hop to confirm
+        self.hop = hop
+        self.route = route if route else []
+        self.ack = ack
 
     def __str__(self):
         return self.msg
 
+class AckMessage(Message):
+    # hop-by-hop confirmation of the CUSTOM message (originator, acked_seq),
+    # sent by sender back to the hop dest that passed it on
+    def __init__(self, sender, dest, originator, acked_seq, addr=None, seq=0):
+        self.seq = seq
+        self.message_type = 'ACK'
+        self.sender = sender
+        self.addr = addr
+        self.dest = dest
+        self.originator = originator
+        self.acked_seq = acked_seq
+
+    def __str__(self):
+        return f'TYPE: {self.message_type}; SENDER: {self.sender}; ACK: {self.originator}/{self.acked_seq}'
+
+class AddrCache(dict):
+    # inet_aton/inet_ntoa results by argument: a node sees the same few
+    # neighbor addresses in every message, and a dict lookup is several times
+    # cheaper than the conversion. Cleared when it reaches limit.
+    def __init__(self, convert, limit=4096):
+        super().__init__()
+        self.convert = convert
+        self.limit = limit
+
+    def __missing__(self, key):
+        if len(self) >= self.limit:
+            self.clear()
+        value = self[key] = self.convert(key)
+        return value
+
+
+class Codec:
+    # Wire format, all integers in network byte order:
+    #
+    #   header:  magic(B) version(B) type(B) seq(H) names_len(H)
+    #   names:   names_len bytes, utf-8 node names separated by NUL; every
+    #            node name in the body is an index(H) into this table
+    #   body:    depends on type
+    #
+    #   HELLO:   sender addrs ansn(H) base_ansn(H) delta(B)
+    #            n(H) name[n](H) flags[n](B) addr_count[n](B) addr[]
+    #            removed(H) name[removed](H)
+    #   TC:      sender addrs ansn(H) base_ansn(H) delta(B)
+    #            n(H) name[n](H) addr_count[n](B) addr[]
+    #            removed(H) name[removed](H)
+    #   CUSTOM:  sender dest addrs msg_len(I) msg n(H) forwarder[n](H)
+    #            mode(B) hop(H) r(H) route[r](H)
+    #   ACK:     sender addrs dest(H) originator(H) acked_seq(H)
+    #
+    # addrs is count(B) followed by 4-byte IPv4 addresses. Per-entry fields
+    # are stored as columns so that each of them is one struct call. seq is
+    # the originator sequence number used for duplicate detection. With
+    # delta=0 the entries are the whole advertised set and base_ansn is
+    # ignored. HELLO flags mark an entry as our MPR, as our MPR selector and
+    # with RESYNC as a neighbor whose HELLO/TC delta chain we lost, asking it
+    # for full snapshots. CUSTOM mode bits say whether hop is set and whether hop-by-hop
+    # ACKs are requested.
+    #
+    # Versions: 1 - initial, 2 - seq in the header, 3 - ANSN and deltas,
+    # 4 - unicast CUSTOM and ACK.
+    MAGIC = 0x4F
+    VERSION = 4
+    TYPES = {'HELLO': 1, 'TC': 2, 'CUSTOM': 3, 'ALERT': 4, 'ACK': 5}
+    TYPE_NAMES = {v: k for k, v in TYPES.items()}
+    LOCAL_MPR = 0x01
+    MPRSS = 0x02
+    RESYNC = 0x04
+    UNICAST = 0x01
+    ACK_REQUESTED = 0x02
+
+    HEADER = struct.Struct('!BBBHH')
+    U8 = struct.Struct('!B')
+    U16 = struct.Struct('!H')
+    U32 = struct.Struct('!I')
+    ANSN = struct.Struct('!HHB')
+    SENDER = struct.Struct('!HB')
+    COLUMNS = {}  # (code, count) -> compiled struct.Struct of code repeated count times
+    PACKED = AddrCache(socket.inet_aton)
+    DOTTED = AddrCache(socket.inet_ntoa)
+
+    @classmethod
+    def __struct__(cls, code, count):
+        compiled = cls.COLUMNS.get((code, count))
+        if compiled is None:
+            compiled = cls.COLUMNS[code, count] = struct.Struct('!' + code * count)
+        return compiled
+
+    @classmethod
+    def __column__(cls, code, values):
+        return cls.__struct__(code, len(values)).pack(*values)
+
+    @classmethod
+    def __addrs__(cls, addrs):
+        return b''.join(map(cls.PACKED.__getitem__, addrs))
+
+    @classmethod
+    def __entries__(cls, msg, body):
+        # HELLO/TC body after the sender, one pass per column and no struct
+        # format parsing, returns the names table
+        entries = msg.neighbors if msg.message_type == 'HELLO' else msg.mpr_set
+        entry_names = list(map(itemgetter('name'), entries))
+        names = dict.fromkeys(chain((msg.sender,), entry_names, msg.removed))
+        index = dict(zip(names, range(len(names))))
+        delta = msg.base_ansn is not None
+        body += cls.ANSN.pack(msg.ansn & 0xFFFF, (msg.base_ansn or 0) & 0xFFFF, delta)
+        body += cls.U16.pack(len(entries))
+        body += cls.__struct__('H', len(entries)).pack(*map(index.__getitem__, entry_names))
+        if msg.message_type == 'HELLO':
+            body += bytes([
+                (cls.LOCAL_MPR if x.get('local_mpr') else 0) | (cls.MPRSS if x.get('mprss') else 0)
+                | (cls.RESYNC if x.get('resync') else 0)
+                for x in entries])
+        addrs = [x.get('addr') or () for x in entries]
+        body += bytes(map(len, addrs))
+        body += cls.__addrs__(chain.from_iterable(addrs))
+        body += cls.U16.pack(len(msg.removed))
+        body += cls.__struct__('H', len(msg.removed)).pack(*map(index.__getitem__, msg.removed))
+        return names
+
+    @classmethod
+    def encode(cls, msg):
+        names = {}
+        intern = lambda name: names.setdefault(name, len(names))
+        body = bytearray(cls.U16.pack(intern(msg.sender)))
+        addr = list(msg.addr) if msg.addr else []
+        body += cls.U8.pack(len(addr)) + cls.__addrs__(addr)
+        if msg.message_type in ('HELLO', 'TC'):
+            names = cls.__entries__(msg, body)
+        elif msg.message_type == 'CUSTOM':
+            body += cls.U16.pack(intern(msg.dest))
+            raw = msg.msg.encode()
+            body += cls.U32.pack(len(raw)) + raw
+            body += cls.U16.pack(len(msg.forwarders))
+            body += cls.__column__('H', [intern(x) for x in msg.forwarders])
+            mode = (cls.UNICAST if msg.hop else 0) | (cls.ACK_REQUESTED if msg.ack else 0)
+            body += cls.U8.pack(mode) + cls.U16.pack(intern(msg.hop) if msg.hop else 0)
+            body += cls.U16.pack(len(msg.route))
+            body += cls.__column__('H', [intern(x) for x in msg.route])
+        elif msg.message_type == 'ACK':
+            body += cls.__column__('H', [intern(msg.dest), intern(msg.originator), msg.acked_seq & 0xFFFF])
+        else:
+            raise Exception(f'Unable to encode message type "{msg.message_type}"')
+        table = '\0'.join(names).encode()
+        header = cls.HEADER.pack(cls.MAGIC, cls.VERSION, cls.TYPES[msg.message_type], msg.seq & 0xFFFF, len(table))
+        return header + table + body
+
+    @classmethod
+    def peek(cls, data):
+        # (type, sender, full) from the header alone; full tells a HELLO/TC
+        # snapshot from a delta and is None for other types
+        view = memoryview(data)
+        magic, version, type_code, _, table_len = cls.HEADER.unpack_from(view, 0)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise Exception(f'Not an OLSR v{cls.VERSION} message')
+        message_type = cls.TYPE_NAMES.get(type_code)
+        offset = cls.HEADER.size
+        names = view[offset:offset + table_len]
+        offset += table_len
+        sender_idx, count = cls.SENDER.unpack_from(view, offset)
+        sender = str(names, 'utf-8').split('\0')[sender_idx]
+        full = None
+        if message_type in ('HELLO', 'TC'):
+            _, _, delta = cls.ANSN.unpack_from(view, offset + 3 + 4 * count)
+            full = not delta
+        return message_type, sender, full
+
+    @classmethod
+    def decode(cls, data):
+        view = memoryview(data)
+        magic, version, type_code, seq, table_len = cls.HEADER.unpack_from(view, 0)
+        if magic != cls.MAGIC:
+            raise Exception(f'Not an OLSR datagram (magic {magic:#x})')
+        if version != cls.VERSION:
+            raise Exception(f'Unsupported wire format version {version}')
+        message_type = cls.TYPE_NAMES.get(type_code)
+        offset = cls.HEADER.size
+        names = str(view[offset:offset + table_len], 'utf-8').split('\0')
+        offset += table_len
+
+        def column(code, count):
+            nonlocal offset
+            compiled = cls.__struct__(code, count)
+            values = compiled.unpack_from(view, offset)
+            offset += compiled.size
+            return values
+
+        def addrs(count):
+            nonlocal offset
+            out = list(map(cls.DOTTED.__getitem__, cls.__struct__('4s', count).unpack_from(view, offset)))
+            offset += 4 * count
+            return out
+
+        def raw(count):
+            # a B column as bytes, indexing gives the ints
+            nonlocal offset
+            offset += count
+            return bytes(view[offset - count:offset])
+
+        sender_idx, count = column('HB', 1)
+        sender = names[sender_idx]
+        addr = addrs(count) or None
+        if message_type in ('HELLO', 'TC'):
+            ansn, base_ansn, delta = column('HHB', 1)
+            base_ansn = base_ansn if delta else None
+            count, = column('H', 1)
+            entry_names = [names[x] for x in column('H', count)]
+            flags = raw(count) if message_type == 'HELLO' else None
+            addr_counts = raw(count)
+            flat = addrs(sum(addr_counts))
+            ends = list(accumulate(addr_counts))
+            if flags is None:
+                entries = [{'name': name, 'addr': flat[end - size:end]}
+                           for name, size, end in zip(entry_names, addr_counts, ends)]
+            else:
+                entries = [{
+                    'name': name,
+                    'addr': flat[end - size:end],
+                    'local_mpr': bool(flag & cls.LOCAL_MPR),
+                    'mprss': bool(flag & cls.MPRSS),
+                    'resync': bool(flag & cls.RESYNC)} for name, size, end, flag in zip(entry_names, addr_counts, ends, flags)]
+            count, = column('H', 1)
+            removed = [names[x] for x in column('H', count)]
+            message_cls = HelloMessage if message_type == 'HELLO' else TcMessage
+            return message_cls(sender, entries, addr=addr, seq=seq, ansn=ansn, base_ansn=base_ansn, removed=removed)
+        elif message_type == 'CUSTOM':
+            dest_idx, size = column('HI', 1)
+            msg = CustomMessage(sender, names[dest_idx], str(view[offset:offset + size], 'utf-8'), addr=addr, seq=seq)
+            offset += size
+            count, = column('H', 1)
+            msg.forwarders = [names[x] for x in column('H', count)]
+            mode, hop = column('BH', 1)
+            msg.hop = names[hop] if mode & cls.UNICAST else None
+            msg.ack = bool(mode & cls.ACK_REQUESTED)
+            count, = column('H', 1)
+            msg.route = [names[x] for x in column('H', count)]
+            return msg
+        elif message_type == 'ACK':
+            dest_idx, originator_idx, acked_seq = column('H', 3)
+            return AckMessage(sender, names[dest_idx], names[originator_idx], acked_seq, addr=addr, seq=seq)
+        raise Exception(f'Unable to decode message type {type_code}')
+
+
+class AdvertisedSet:
+    # Sender side of HELLO/TC deltas. Tracks the advertised entries (by
+    # name), bumps the ANSN whenever they change and keeps the last changes
+    # so a message can carry only what changed since the previous one.
+    def __init__(self, history=16):
+        self.ansn = 0
+        self.entries = {}
+        self.history = deque(maxlen=history)  # (ansn, changed entries, removed names)
+
+    def update(self, entries):
+        new = {x['name']: dict(x) for x in entries}
+        changed = {k: v for k, v in new.items() if self.entries.get(k) != v}
+        removed = set(self.entries) - set(new)
+        if changed or removed:
+            self.ansn = (self.ansn + 1) & 0xFFFF
+            self.history.append((self.ansn, changed, removed))
+            self.entries = new
+        return bool(changed or removed)
+
+    def delta_since(self, ansn):
+        # (changed entries, removed names) turning set ansn into the current
+        # one, or None if that is older than the kept history
+        if ansn == self.ansn:
+            return [], []
+        changes = list(self.history)
+        for idx, (x, _, _) in enumerate(changes):
+            if x == (ansn + 1) & 0xFFFF:
+                break
+        else:
+            return None
+        changed, removed = {}, set()
+        for _, ch, rm in changes[idx:]:
+            for name in rm:
+                changed.pop(name, None)
+            removed |= rm
+            removed -= set(ch)
+            changed.update(ch)
+        return list(changed.values()), sorted(removed)
+
+
+class ReceivedSets:
+    # Receiver side: the last known advertised set of every originator, per
+    # message type. apply() returns the full entry list a message stands
+    # for, or None when it is a delta on top of a set we do not have (a
+    # gap). After a gap every delta of that originator is refused until the
+    # next full snapshot, which the node asks for with the RESYNC flag.
+    def __init__(self):
+        self.sets = {}  # (message_type, originator) -> (ansn, {name: entry})
+        self.missing = set()  # (message_type, originator) waiting for a full snapshot
+        self.gaps = 0
+
+    def apply(self, msg, entries):
+        key = (msg.message_type, msg.sender)
+        if msg.base_ansn is None:
+            current = {x['name']: x for x in entries}
+            self.missing.discard(key)
+        else:
+            known = self.sets.get(key)
+            if key in self.missing or known is None or known[0] != msg.base_ansn:
+                self.gaps += 1
+                self.missing.add(key)
+                return None
+            current = dict(known[1])
+            for name in msg.removed:
+                current.pop(name, None)
+            for x in entries:
+                current[x['name']] = x
+        self.sets[key] = (msg.ansn, current)
+        return list(current.values())
+
+    def gapped(self, originator):
+        return ('HELLO', originator) in self.missing or ('TC', originator) in self.missing
+
+    def names(self, message_type, originator):
+        # the last known advertised set of originator, empty if none
+        return set(self.sets.get((message_type, originator), (None, {}))[1])
+
+    def advertises(self, originator, name):
+        # whether the last known HELLO or TC of originator lists name
+        return any(name in self.sets.get((x, originator), (None, {}))[1] for x in ('HELLO', 'TC'))
+
+    def forget(self, originator):
+        for message_type in ('HELLO', 'TC'):
+            self.sets.pop((message_type, originator), None)
+            self.missing.discard((message_type, originator))
+
+
 class MessageHandler:
     def __pack__(self, message_type, **args):
-        return pickle.dumps(Message().from_type(message_type, **args))
+        return Codec.encode(Message().from_type(message_type, **args))
 
     def unpack(self, message):
-        return pickle.loads(message)
+        return Codec.decode(message)
+
+    def hello_message(self, sender, neighbor_table, addr=None, ansn=0, base_ansn=None, removed=None):
+        return Message().from_type('HELLO', sender=sender, neighbor_table=neighbor_table, addr=addr,
+                                   ansn=ansn, base_ansn=base_ansn, removed=removed)
 
-    def hello_message(self, sender, neighbor_table, addr=None):
-        return Message().from_type('HELLO', sender=sender, neighbor_table=neighbor_table, addr=addr)
+    def tc_message(self, sender, mpr_set, addr=None, ansn=0, base_ansn=None, removed=None):
+        return Message().from_type('TC', sender=sender, mpr_set=mpr_set, addr=addr,
+                                   ansn=ansn, base_ansn=base_ansn, removed=removed)
 
-    def tc_message(self, sender, mpr_set, addr=None):
-        return Message().from_type('TC', sender=sender, mpr_set=mpr_set, addr=addr)
+    def custom_message(self, sender, dest, msg, addr=None, hop=None, route=None, ack=False):
+        return Message().from_type('CUSTOM', sender=sender, dest=dest, msg=msg, addr=addr,
+                                   hop=hop, route=route, ack=ack)
 
-    def custom_message(self, sender, dest, msg, addr=None):
-        return Message().from_type('CUSTOM', sender=sender, dest=dest, msg=msg, addr=addr)
+    def ack_message(self, sender, dest, originator, acked_seq):
+        return Message().from_type('ACK', sender=sender, dest=dest, originator=originator, acked_seq=acked_seq)
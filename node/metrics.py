@@ -0,0 +1,213 @@
+import json
+import time
+import bisect
+import threading
+
+
+class Histogram:
+    # Cumulative-bucket histogram as Prometheus expects it, in seconds.
+    BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total, out = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+
+class Metrics:
+    # Counters, histograms and gauges of one node. Counters and histograms
+    # are keyed by name and the label pairs as passed (keyword order is fixed
+    # per call site), labels are normalized only when rendering. Gauges are
+    # callables read at render time, so queue depths and the like cost
+    # nothing on the hot path.
+    def __init__(self, prefix='olsr', **labels):
+        self.prefix = prefix
+        self.labels = self.__key__(prefix, labels)[1]  # added to every sample
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def __key__(name, labels):
+        # label values are strings on the wire, None becomes ''
+        return name, tuple(sorted((k, '' if v is None else str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, read, **labels):
+        self.gauges[self.__key__(name, labels)] = read
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def __collect__(self):
+        # (counters, histograms) with normalized keys, same series merged
+        counters, histograms = {}, {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                key = self.__key__(name, dict(labels))
+                counters[key] = counters.get(key, 0) + value
+            for (name, labels), h in self.histograms.items():
+                key = self.__key__(name, dict(labels))
+                merged = histograms.get(key)
+                if merged is None:
+                    merged = histograms[key] = Histogram(h.buckets)
+                merged.counts = [a + b for a, b in zip(merged.counts, h.counts)]
+                merged.sum += h.sum
+                merged.count += h.count
+        return sorted(counters.items()), sorted(histograms.items(), key=lambda x: x[0])
+
+    def __labels__(self, labels, extra=()):
+        pairs = self.labels + labels + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        counters, histograms = self.__collect__()
+        typed = set()
+        for (name, labels), value in counters:
+            name = f'{self.prefix}_{name}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self.__labels__(labels)} {value}')
+        for (name, labels), h in histograms:
+            name = f'{self.prefix}_{name}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, cumulative in h.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{self.__labels__(labels, (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{self.__labels__(labels)} {h.sum}')
+            lines.append(f'{name}_count{self.__labels__(labels)} {h.count}')
+        for (name, labels), read in sorted(self.gauges.items(), key=lambda x: x[0]):
+            name = f'{self.prefix}_{name}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{self.__labels__(labels)} {read()}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        counters, histograms = self.__collect__()
+        counters = [
+            {'name': name, 'labels': dict(labels), 'value': value}
+            for (name, labels), value in counters]
+        histograms = [
+            {'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum,
+             'buckets': [[bound if bound != float('inf') else '+Inf', c] for bound, c in h.cumulative()]}
+            for (name, labels), h in histograms]
+        gauges = [
+            {'name': name, 'labels': dict(labels), 'value': read()}
+            for (name, labels), read in sorted(self.gauges.items(), key=lambda x: x[0])]
+        return {'time': time.time(), 'labels': dict(self.labels),
+                'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+
+    def serve(self, port, host='127.0.0.1'):
+        # GET /metrics (any path, really) from a daemon thread
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+class Timer:
+    # with metrics.timer('name'): ... observes the elapsed wall time
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class TimedLock:
+    # Drop-in for threading.RLock that records how long callers waited for
+    # it and how long the outermost holder kept it.
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.lock = threading.RLock()
+        self.local = threading.local()
+
+    def acquire(self, blocking=True, timeout=-1):
+        depth = getattr(self.local, 'depth', 0)
+        if depth:
+            self.lock.acquire()
+            self.local.depth = depth + 1
+            return True
+        start = time.perf_counter()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.local.acquired = time.perf_counter()
+        self.local.depth = 1
+        self.metrics.observe('lock_wait_seconds', self.local.acquired - start, lock=self.name)
+        return True
+
+    def release(self):
+        self.local.depth -= 1
+        if not self.local.depth:
+            held = time.perf_counter() - self.local.acquired
+            self.lock.release()
+            self.metrics.observe('lock_hold_seconds', held, lock=self.name)
+        else:
+            self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,75 @@
+import heapq
+from collections import defaultdict
+
+
+class MprSelector:
+    # Incremental MPR selection. Keeps, for every 1-hop neighbor, the set of
+    # nodes it advertised in its last HELLO and the reverse coverage index
+    # (2-hop node -> 1-hop neighbors reaching it). Both are patched only when
+    # a HELLO differs from the previous one, and the greedy selection runs
+    # only if something was patched since the last call.
+    def __init__(self, name):
+        self.name = name
+        self.links = {}  # 1-hop neighbor -> frozenset of its neighbors
+        self.coverage = defaultdict(set)  # node -> 1-hop neighbors linked to it
+        self.mprs = set()
+        self.dirty = False
+
+    def update(self, neighbor, neighbors):
+        neighbors = frozenset(neighbors) - {self.name}
+        old = self.links.get(neighbor)
+        if old == neighbors:
+            return False
+        old = old if old is not None else frozenset()
+        for x in old - neighbors:
+            self.__uncover__(x, neighbor)
+        for x in neighbors - old:
+            self.coverage[x].add(neighbor)
+        self.links[neighbor] = neighbors
+        self.dirty = True
+        return True
+
+    def remove(self, neighbor):
+        if neighbor not in self.links:
+            return False
+        for x in self.links.pop(neighbor):
+            self.__uncover__(x, neighbor)
+        self.dirty = True
+        return True
+
+    def __uncover__(self, node, neighbor):
+        covering = self.coverage.get(node)
+        if covering is not None:
+            covering.discard(neighbor)
+            if not covering:
+                del self.coverage[node]
+
+    def two_hop(self):
+        return {x for x in self.coverage if x not in self.links}
+
+    def select(self):
+        if not self.dirty:
+            return self.mprs
+        uncovered = self.two_hop()
+        # how many still uncovered 2-hop nodes every 1-hop neighbor reaches,
+        # the heap holds (-count, name) and is corrected lazily on pop
+        counts = {n: len(nbrs & uncovered) for n, nbrs in self.links.items()}
+        heap = [(-c, n) for n, c in counts.items() if c]
+        heapq.heapify(heap)
+        mprs = set()
+        while uncovered and heap:
+            count, node = heapq.heappop(heap)
+            if node in mprs:
+                continue
+            if -count != counts[node]:
+                if counts[node]:
+                    heapq.heappush(heap, (-counts[node], node))
+                continue
+            mprs.add(node)
+            for x in self.links[node] & uncovered:
+                uncovered.discard(x)
+                for other in self.coverage[x]:
+                    counts[other] -= 1
+        self.mprs = mprs
+        self.dirty = False
+        return mprs
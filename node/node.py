@@ -1,14 +1,27 @@
+import os
 import sys
 import yaml
 import socket
 import time
 import logging
 import threading
-import netifaces
+import random
 import re
 import message
-import networkx as nx
-import matplotlib.pyplot as plt
+from packet import Packet, Outbox
+from mpr import MprSelector
+from topology import DistanceIndex, TOPOLOGY_STORES
+from routing import RoutingTable
+from duplicates import DuplicateSet
+from ingress import UpdateWorker, IngressQueue
+from timers import TimerWheel
+from metrics import Metrics, TimedLock
+from state import TopologyState
+from forwarding import RetransmitQueue
+from scheduler import Scheduler
+from transport import UdpTransport
+from runtime import AsyncioTransport
+import render
 from copy import copy
 from random import choice, randint
 
@@ -30,30 +43,42 @@ def create_logger(logger_name, threads=True):
 
 
 class Listerner:
-    def __init__(self, interfaces, listerning_port, listerning_time=None, logger=None, handler=None):
+    BURST = 64
+
+    def __init__(self, interfaces, listerning_port, listerning_time=None, logger=None, handler=None, transport=None):
         self.logger = logger if logger else create_logger('listener-logger')
         self.PORT = listerning_port
         self.LISTERNING_TIME = listerning_time
         self.interfaces = interfaces if interfaces else ['']
-        self.sockets = {x: self.__create_socket__(x) for x in self.interfaces}
+        self.transport = transport if transport else UdpTransport(listerning_port)
+        # one socket for all interfaces: a socket per interface bound to the
+        # same port got every broadcast once per interface
+        self.sockets = {'all': self.__create_socket__(None)}
         self.handler = handler
 
     def __create_socket__(self, iface):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        sock.setblocking(0)
-        sock.settimeout(self.LISTERNING_TIME)
-        sock.bind(('', self.PORT))
-        return sock
+        return self.transport.listen_socket(iface, self.LISTERNING_TIME)
 
     def run(self, return_threads=False, background=False):
         def listen(sock):
             timeout = (time.time() + self.LISTERNING_TIME) if self.LISTERNING_TIME else False
+            # one preallocated buffer per socket; after a blocking receive the
+            # socket is drained without waiting, up to BURST datagrams
+            buf = bytearray(65535)
+            view = memoryview(buf)
             while True:
                 try:
-                    data, addr = sock.recvfrom(4096)
-                    if self.handler:
-                        self.handler(data, addr[0])
+                    nbytes, addr, iface = self.transport.receive_into(sock, buf)
+                    for idx in range(self.BURST):
+                        if self.handler:
+                            self.handler(bytes(view[:nbytes]), addr, iface)
+                        if idx == self.BURST - 1:
+                            # back to the blocking receive with nothing pending
+                            break
+                        try:
+                            nbytes, addr, iface = self.transport.receive_into(sock, buf, socket.MSG_DONTWAIT)
+                        except BlockingIOError:
+                            break
                     if timeout and time.time() > timeout:
                         break
                 except socket.timeout:
@@ -67,122 +92,287 @@ class Listerner:
         if return_threads:
             return threads
 
-class Broadcaster:
-    def __init__(self, msg, interfaces=None, msg_send_callback=None, broadcast_port=None,
-                                    broadcast_time=None, broadcast_sleep=30, logger=None):
-        self.UDP_IP = '<broadcast>'
-        self.UDP_PORT = broadcast_port if broadcast_port else 37020
-        self.interfaces = interfaces if interfaces else ['']
-        self.BROADCAST_TIME = broadcast_time
-        self.BROADCAST_SLEEP = broadcast_sleep
-        self.msg = msg
-        self.msg_send_callback = msg_send_callback if msg_send_callback else lambda: True
-        self.logger = logger if logger else create_logger('broadcast-logger')
-        self.sockets = {x: self.__create_socket__(x) for x in self.interfaces}
-
-    def __create_socket__(self, iface):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.settimeout(0.2)
-        sock.setblocking(0)
-        sock.bind((netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['addr'], 1234))
-        return sock
-
-    def run(self, return_threads=False, background=False):
-        def broadcast(sock):
-            timeout = (time.time() + self.BROADCAST_TIME) if self.BROADCAST_TIME else False
-            while True:
-                if self.msg_send_callback():
-                    sock.sendto(self.msg.make(), (self.UDP_IP, self.UDP_PORT))
-                time.sleep(self.BROADCAST_SLEEP)
-                if timeout and time.time() > timeout:
-                    break
-        threads = [threading.Thread(target=broadcast, name=f'broadcast_{iface}', args=(socket,)) for iface, socket in self.sockets.items()]
-        for thread in threads:
-            if background:
-                thread.daemon = True
-            thread.start()
-        if return_threads:
-            return threads
-
 class Node:
     CONF_PATH = 'config.yml'
 
-    def __init__(self, config=CONF_PATH):
-        cfg = yaml.load(open(config, 'r'), Loader=yaml.Loader)
-        self.side = cfg['side']
+    def __init__(self, config=CONF_PATH, transport=None, logger=None):
+        # config is either a path to the node yaml or an already parsed dict
+        cfg = config if isinstance(config, dict) else yaml.load(open(config, 'r'), Loader=yaml.Loader)
+        self.side = cfg.get('side', 'good')
         self.name = cfg['name']
         self.network = cfg['networks']
         self.broadcast_port = cfg.get('broadcast_port', 37020)
         self.interface_pattern = cfg.get('interface_pattern', 'eth')
+        self.broadcast_sleep = cfg.get('broadcast_sleep', 30)
+        # adaptive emission: min_interval after the advertised sets change,
+        # doubled after every emission up to max_interval while nothing
+        # changes; otherwise a fixed broadcast_sleep. Hold times follow
+        # max_interval, raise it to trade failure detection for traffic.
+        self.adaptive_intervals = cfg.get('adaptive_intervals', True)
+        self.min_interval = cfg.get('min_interval', 2)
+        self.max_interval = cfg.get('max_interval', self.broadcast_sleep) if self.adaptive_intervals else self.broadcast_sleep
+        self.emit_interval = self.min_interval if self.adaptive_intervals else self.broadcast_sleep
         self.ip_addr = socket.gethostbyname(socket.gethostname())
-        self.logger = create_logger(f'{self.name}-logger', threads=False)
-        # https://networkx.github.io/documentation/stable/reference/drawing.html
-        visualize_mode = cfg.get('visualize_mode')
-        if visualize_mode:
-            visualize_mode = f'draw_{visualize_mode}'
+        self.logger = logger if logger else create_logger(f'{self.name}-logger', threads=False)
+        # runtime: asyncio (one event loop thread) or threads (thread per socket)
+        if transport:
+            self.transport = transport
+        elif cfg.get('runtime', 'asyncio') == 'threads':
+            self.transport = UdpTransport(self.broadcast_port, self.interface_pattern)
         else:
-            visualize_mode = 'draw'
-        try:
-            self.visualize_method = getattr(nx, visualize_mode)
-            # self.logger.warning(f"Using {visualize_mode} to visualize")
-        except AttributeError:
-            # self.logger.warning(f"Unable to use {visualize_mode} to visualize, fall back to draw")
-            self.visualize_method = nx.draw
-        self.local_interfaces = {x: netifaces.ifaddresses(x)[netifaces.AF_INET][0]['addr'] for x in [i for i in netifaces.interfaces() if self.interface_pattern in i]}
+            self.transport = AsyncioTransport(self.broadcast_port, self.interface_pattern, logger=self.logger)
+        # https://networkx.github.io/documentation/stable/reference/drawing.html
+        # draw_<visualize_mode> is looked up by the render worker, draw if unset
+        self.visualize_mode = cfg.get('visualize_mode')
+        # worker: draw PNGs in a worker process right away; snapshot: append
+        # snapshots to artifacts/snapshots/<name>.jsonl for render.py
+        self.render_mode = cfg.get('render', 'worker')
+        self.local_interfaces = self.transport.local_interfaces
+        self.metrics = Metrics(node=self.name)
+        # path MTU for bundling several messages into one datagram
+        self.outbox = Outbox(self.transport, mtu=cfg.get('mtu', 1472), metrics=self.metrics)
         # self.logger.info(
         #     f'{self.name} created in {self.network}. Local interfaces: {self.local_interfaces}')
-        self.network_graph = nx.Graph()
-        self.network_graph.add_node(self.name, addr=self.local_interfaces.values())
+        # networkx (default) or compact, see topology.py
+        self.network_graph = TOPOLOGY_STORES[cfg.get('topology_store', 'networkx')]()
+        self.network_graph.add_node(self.name, addr=list(self.local_interfaces.values()))
+        self.distances = DistanceIndex(self.network_graph)
+        self.routing_table = RoutingTable(self.network_graph, self.distances, self.name, metrics=self.metrics)
         self.neighbor_table = []
         self.mpr_set = []
-        self.lock = threading.RLock()
+        self.mpr_selector = MprSelector(self.name)
+        self.neighbor_ifaces = {}  # 1-hop neighbor -> interfaces its HELLOs arrive on
+        self.seq = 0
+        self.clock = self.transport.clock
+        # every periodic and one-shot job of the node, run on the
+        # scheduler's own thread
+        self.scheduler = Scheduler(clock=self.clock, jitter=cfg.get('jitter', 0.25),
+                                   rng=random.Random(cfg.get('jitter_seed')), logger=self.logger)
+        # TC and flooded CUSTOM relays wait a random part of relay_jitter
+        # seconds (RFC 3626 MAXJITTER), so MPRs hearing the same message do
+        # not all resend at once; simulations relay right away
+        self.relay_jitter = cfg.get('relay_jitter', 0 if self.transport.simulated else self.min_interval / 4)
+        self.relays = []
+        self.duplicates = DuplicateSet(hold_time=cfg.get('duplicate_hold_time', 30), clock=self.clock)
+        # validity of learned links, refreshed by every HELLO/TC advertising them
+        self.neighbor_hold_time = cfg.get('neighbor_hold_time', 3 * self.max_interval)
+        self.topology_hold_time = cfg.get('topology_hold_time', 3 * self.max_interval)
+        self.link_timers = TimerWheel(now=self.clock())
+        # links restored from the state file, until a HELLO/TC confirms them
+        self.stale = set()
+        # HELLO/TC carry only the changes since the previous emission, with a
+        # full snapshot every full_snapshot_every messages (1 disables deltas)
+        self.full_snapshot_every = cfg.get('full_snapshot_every', 5)
+        self.advertised = {'HELLO': message.AdvertisedSet(), 'TC': message.AdvertisedSet()}
+        self.sent_ansn = {'HELLO': None, 'TC': None}
+        self.emitted = {'HELLO': 0, 'TC': 0}
+        self.received = message.ReceivedSets()
+        # types to send in full next, a neighbor lost their delta chain
+        self.resync = set()
+        # CUSTOM messages: flood (relayed by every MPR), next_hop (each hop
+        # picks the next one from its routing table) or source_route (the
+        # originator's path travels with the message); the latter two can
+        # ask every hop for an ACK and are then resent until confirmed
+        self.custom_forwarding = cfg.get('custom_forwarding', 'flood')
+        self.custom_ack = cfg.get('custom_ack', False)
+        self.retransmits = RetransmitQueue(
+            timeout=cfg.get('ack_timeout', 1.0),
+            max_retries=cfg.get('max_retransmits', 3),
+            max_size=cfg.get('retransmit_queue_size', 256),
+            clock=self.clock)
+        self.hello = message.MessageHandler().hello_message(self.name, self.neighbor_table)
+        self.tc = message.MessageHandler().tc_message(self.name, self.mpr_set)
+        self.lock = TimedLock(self.metrics, 'node')
+        # received messages are queued by type priority and applied in
+        # batches by one worker thread, unless the transport delivers
+        # synchronously (simulation); per-type overrides of the queue bounds,
+        # overload policies and per-sender [rate, burst] limits as in
+        # IngressQueue
+        self.update_worker = None
+        if not self.transport.simulated:
+            self.update_worker = UpdateWorker(
+                self.__update_topology_batch__,
+                maxsize=cfg.get('update_queue_size', 1024),
+                debounce=cfg.get('update_debounce', 0.05),
+                logger=self.logger,
+                sizes=cfg.get('ingress_queue_sizes'),
+                policies=cfg.get('ingress_policies'),
+                rates=cfg.get('ingress_rate_limits'))
+            self.update_worker.start()
+            ingress = self.update_worker.queue
+            self.metrics.gauge('update_queue_depth', ingress.qsize)
+            self.metrics.gauge('update_queue_dropped', lambda: self.update_worker.dropped)
+            for kind in IngressQueue.PRIORITIES:
+                self.metrics.gauge('ingress_queue_depth', lambda kind=kind: ingress.qsize(kind), type=kind)
+                for reason in ('rate', 'full', 'shed', 'coalesced', 'malformed'):
+                    self.metrics.gauge('ingress_dropped', lambda key=(kind, reason): ingress.dropped[key],
+                                       type=kind, reason=reason)
+            self.metrics.gauge('ingress_dropped', lambda: ingress.dropped['unknown', 'malformed'],
+                               type='unknown', reason='malformed')
+        self.metrics.gauge('outbox_pending', lambda: sum(len(x) for x in self.outbox.pending.values()))
+        self.metrics.gauge('duplicates_size', lambda: len(self.duplicates.entries))
+        for kind in ('TC', 'CUSTOM'):
+            self.metrics.gauge('duplicates_suppressed', lambda kind=kind: self.duplicates.suppressed[kind], type=kind)
+        self.metrics.gauge('link_timers', lambda: len(self.link_timers))
+        self.metrics.gauge('topology_nodes', lambda: len(self.network_graph))
+        self.metrics.gauge('stale_links', lambda: len(self.stale))
+        self.metrics.gauge('delta_gaps', lambda: self.received.gaps)
+        self.metrics.gauge('emit_interval_seconds', lambda: self.emit_interval)
+        self.metrics.gauge('scheduled_jobs', lambda: len(self.scheduler))
+        self.metrics.gauge('retransmit_queue', lambda: len(self.retransmits))
+        for reason in ('evicted', 'retries'):
+            self.metrics.gauge('retransmit_dropped', lambda reason=reason: self.retransmits.dropped[reason], reason=reason)
+        # Prometheus text endpoint on localhost and/or a periodic JSON dump
+        # into artifacts/, both off by default
+        self.metrics_port = cfg.get('metrics_port')
+        self.metrics_dump_every = cfg.get('metrics_dump_every')
+        self.metrics_server = None
+        if self.metrics_port and not self.transport.simulated:
+            self.metrics_server = self.metrics.serve(self.metrics_port)
+        # warm start: topology, roles and sequence numbers saved periodically
+        # and reloaded on start, both on by default outside simulations
+        self.state_file = cfg.get('state_file', f'artifacts/{self.name}.state')
+        self.state_save_every = cfg.get('state_save_every', None if self.transport.simulated else self.broadcast_sleep)
+        self.state_max_age = cfg.get('state_max_age', 600)
+        if cfg.get('warm_start', not self.transport.simulated):
+            self.restore_state()
+        self.__schedule__()
         self.update_topology()
 
     def get_neighbors(self, node=None, dist=1):
         if not node:
             node = self.name
-        return [
-            x for x in nx.single_source_shortest_path_length(self.network_graph, node, cutoff=dist) 
-            if nx.single_source_shortest_path_length(self.network_graph, node, cutoff=dist)[x] == dist
-        ]
+        return self.distances.at(node, dist)
+
+    def __add_edge__(self, u, v, hold_time=None):
+        if hold_time:
+            key = (u, v) if u < v else (v, u)
+            self.stale.discard(key)
+            deadline = self.clock() + hold_time
+            # the same link may be advertised by HELLO and TC, keep the later one
+            if self.link_timers.deadlines.get(key, 0) < deadline:
+                self.link_timers.schedule(key, deadline)
+        if self.network_graph.has_edge(u, v):
+            return False
+        self.network_graph.add_edge(u, v)
+        self.distances.edge_added(u, v)
+        return True
 
-    def is_am_MPR(self):
-        if not self.get_by('mprss'):
+    def __remove_edge__(self, u, v):
+        if not self.network_graph.has_edge(u, v):
             return False
+        self.network_graph.remove_edge(u, v)
+        self.distances.edge_removed(u, v)
+        key = (u, v) if u < v else (v, u)
+        self.stale.discard(key)
+        self.link_timers.cancel(key)
+        if self.name in (u, v):
+            # lost a 1-hop neighbor
+            nbr = v if u == self.name else u
+            self.mpr_selector.remove(nbr)
+            self.neighbor_ifaces.pop(nbr, None)
+            # what it advertised is not kept current any more, do not let it
+            # hold up the removal of its links
+            self.received.forget(nbr)
+            self.network_graph.add_node(nbr, mprss=False, local_mpr=False)
+        for node in (u, v):
+            if node != self.name and not self.network_graph.degree(node):
+                self.network_graph.remove_node(node)
+                self.received.forget(node)
         return True
 
+    def expire(self):
+        # drop links whose hold time passed, returns how many were removed
+        with self.lock:
+            expired = self.link_timers.advance(self.clock())
+            removed = sum(1 for u, v in expired if self.__remove_edge__(u, v))
+            if removed:
+                self.__commit__(True)
+            return removed
+
+    def is_am_MPR(self):
+        return self.network_graph.any_with('mprss')
+
     def get_notwork_info(self):
-        return f'{self.network_graph.edges()}\n{self.network_graph.nodes().data()}'
+        return f'{self.network_graph.edges()}\n{[(x, self.get_data(x)) for x in self.network_graph]}'
+
+    def __update_topology__(self, data, addr, iface=None):
+        with self.metrics.timer('update_topology_seconds'), self.lock:
+            self.metrics.inc('rx_datagrams_total', iface=iface)
+            changed = False
+            for part in Packet.split(data):
+                changed = self.__apply__(message.MessageHandler().unpack(part), addr, iface) or changed
+            self.__commit__(changed)
+
+    def __update_topology_batch__(self, batch):
+        # one lock acquisition and one neighbor/MPR recomputation per batch
+        with self.metrics.timer('update_topology_seconds'), self.lock:
+            self.metrics.observe('update_batch_size', len(batch))
+            changed = False
+            for data, addr, iface in batch:
+                # one message each, split by the ingress queue
+                try:
+                    changed = self.__apply__(message.MessageHandler().unpack(data), addr, iface) or changed
+                except Exception as e:
+                    self.logger.error(f'Unable to handle message from {addr}: {e}')
+            self.__commit__(changed)
+
+    def __receive__(self, data, addr, iface=None):
+        if self.update_worker:
+            self.metrics.inc('rx_datagrams_total', iface=iface)
+            self.update_worker.put(data, addr, iface)
+        else:
+            self.__update_topology__(data, addr, iface)
 
-    def __update_topology__(self, data, addr):
+    def __apply__(self, m, addr, iface=None):
+        # Apply one message to the graph. Returns True if neighbor_table or
+        # mpr_set have to be rebuilt, which __commit__ does.
         with self.lock:
-            m = message.MessageHandler().unpack(data)
+            self.metrics.inc('rx_messages_total', type=m.message_type, iface=iface)
+            changed = False
             if m.message_type == 'HELLO':
                 if addr not in self.local_interfaces.values(): # not our broadcast msg
-                    # add node and edge
-                    self.network_graph.add_node(m.sender, addr=[addr])
-                    self.network_graph.add_edge(self.name, m.sender)
-                    for nbr in m.neighbors:
-                        # if me in sender's neighbors and he marked me as a MPR - mark him as mprss
-                        if nbr['name'] == self.name and nbr.get('local_mpr'):
-                            self.network_graph.add_node(m.sender, addr=[addr], mprss=True)
-                        self.network_graph.add_edge(m.sender, nbr['name'])
+                    gapped = self.received.gapped(m.sender)
+                    advertised = self.received.names('HELLO', m.sender)
+                    neighbors = self.received.apply(m, m.neighbors)
+                    # our own entry is in a delta whenever its flags change
+                    if any(x['name'] == self.name and x.get('resync') for x in m.neighbors):
+                        self.__resync__()
+                    if iface:
+                        self.neighbor_ifaces.setdefault(m.sender, set()).add(iface)
+                    # add node and edge, from a delta we cannot apply too: the
+                    # link is up either way, its neighbors follow in full
+                    # once our HELLO asks for it
+                    changed = self.__update_neighbor__(m.sender, addr, neighbors)
+                    changed = self.__add_edge__(self.name, m.sender, self.neighbor_hold_time) or changed
+                    changed = changed or gapped != self.received.gapped(m.sender)
+                    if neighbors is not None:
+                        for nbr in neighbors:
+                            self.__add_edge__(m.sender, nbr['name'], self.neighbor_hold_time)
+                        self.__withdraw__(m.sender, advertised - {x['name'] for x in neighbors})
             elif m.message_type == 'TC':
-                if addr not in self.local_interfaces.values():
-                    if m.sender in self.get_neighbors(dist=2):
+                if addr not in self.local_interfaces.values() and not self.duplicates.check(m.sender, 'TC', m.seq):
+                    gapped = self.received.gapped(m.sender)
+                    advertised = self.received.names('TC', m.sender)
+                    mpr_set = self.received.apply(m, m.mpr_set)
+                    changed = gapped != self.received.gapped(m.sender)
+                    if mpr_set is not None and self.distances.distance(self.name, m.sender, 2) == 2:
                         # mark as MPR (somebody's MBR, nonlocal)
                         self.network_graph.add_node(m.sender, mpr=True)
-                        for nbr in m.mpr_set:
+                        for nbr in mpr_set:
                             # print(f"Adding {nbr['name']}")
-                            self.network_graph.add_edge(m.sender, nbr['name'])
+                            if self.__add_edge__(m.sender, nbr['name'], self.topology_hold_time) and nbr['name'] == self.name:
+                                changed = True
+                        self.__withdraw__(m.sender, advertised - {x['name'] for x in mpr_set})
                     if self.is_am_MPR():
-                        Broadcaster(m, self.local_interfaces.keys(),
-                        broadcast_port=self.broadcast_port, broadcast_time=5, logger=self.logger).run()
+                        self.__forward__(m.make())
             elif m.message_type == 'CUSTOM':
                 if addr not in self.local_interfaces.values():
-                    if m.dest == self.name:
+                    if m.hop:
+                        # unicast: only the designated hop handles it
+                        if m.hop == self.name:
+                            self.__relay__(m)
+                    elif m.dest == self.name:
                         self.logger.info(f'Got CUSTOM message from {m.sender}: {m.msg}; path: {m.forwarders}')
                         try:
                             self.visualize_route(m.forwarders)
@@ -192,92 +382,365 @@ class Node:
                         if self.is_am_MPR():
                             if m.sender != self.name:
                                 if self.side == 'good':
-                                    if self.name not in m.forwarders:
+                                    if self.name not in m.forwarders and not self.duplicates.check(m.sender, 'CUSTOM', m.seq):
                                         self.logger.info(f'I got msg from {m.sender} to {m.dest}. Its prev path: {m.forwarders}. Forwarding...')
                                         m.forwarders.append(self.name)
-                                        Broadcaster(m, self.local_interfaces.keys(),
-                                        broadcast_port=self.broadcast_port, broadcast_time=1, logger=self.logger).run()
+                                        self.__forward__(m.make())
                                 elif self.side == 'evil':
                                     self.logger.info(f'I got msg from {m.sender} to {m.dest}. Its prev path: {m.forwarders}. Dropping...')
-            self.update_neighbors()
-            self.update_MPRs()
-            self.update_MPR_set()
+            elif m.message_type == 'ACK':
+                if m.dest == self.name and self.retransmits.ack((m.originator, m.acked_seq), m.sender):
+                    self.metrics.inc('custom_acked_total')
+            return changed
+
+    def __forward__(self, data):
+        # Relay a broadcast message. Relays pending together go out bundled
+        # by one one-shot job, scheduled when the first of them comes in.
+        if not self.relay_jitter:
+            self.outbox.broadcast(data)
+            return
+        self.relays.append(data)
+        if len(self.relays) == 1:
+            self.scheduler.after('relay', self.scheduler.rng.uniform(0, self.relay_jitter), self.__relay_pending__)
+
+    def __relay_pending__(self):
+        with self.lock:
+            for data in self.relays:
+                self.outbox.broadcast(data)
+            self.relays.clear()
+            self.outbox.flush()
+
+    def __ifaces__(self, nbr):
+        # interfaces a neighbor is heard on, all of them if not known yet
+        # (e.g. a link restored from the state file)
+        return sorted(self.neighbor_ifaces.get(nbr) or self.local_interfaces)
+
+    def __route__(self, m):
+        # Set the designated next hop of a unicast CUSTOM message: the entry
+        # after us in its source route, or our own first hop towards dest.
+        # False if there is no usable one.
+        with self.lock:
+            if m.route:
+                idx = m.route.index(self.name) if self.name in m.route[:-1] else None
+                hop = m.route[idx + 1] if idx is not None else None
+            else:
+                hop = self.routing_table.next_hop(m.dest)
+            if not hop or hop == self.name or not self.network_graph.has_edge(self.name, hop):
+                self.metrics.inc('custom_undelivered_total', reason='no_route')
+                self.logger.info(f'No next hop from {self.name} towards {m.dest}, dropping message from {m.sender}')
+                return False
+            m.hop = hop
+            return True
+
+    def __unicast__(self, m, data):
+        # one copy on the links to the next hop, kept until it ACKs if asked
+        with self.lock:
+            ifaces = self.__ifaces__(m.hop)
+            for iface in ifaces:
+                self.outbox.send(iface, data)
+            if m.ack:
+                self.retransmits.add((m.sender, m.seq), m.hop, ifaces, data)
+
+    def __relay__(self, m):
+        # we are the designated hop of a unicast CUSTOM message
+        with self.lock:
+            if m.ack:
+                # confirmed again for a duplicate too, the first ACK may be lost
+                prev = m.forwarders[-1]
+                data = message.MessageHandler().ack_message(self.name, prev, m.sender, m.seq).make()
+                for iface in self.__ifaces__(prev):
+                    self.outbox.send(iface, data)
+            if self.duplicates.check(m.sender, 'CUSTOM', m.seq):
+                return
+            if m.dest == self.name:
+                self.logger.info(f'Got CUSTOM message from {m.sender}: {m.msg}; path: {m.forwarders}')
+                try:
+                    self.visualize_route(m.forwarders)
+                except Exception as e:
+                    self.logger.error(f'{e}\n{self.network_graph}')
+            elif self.side == 'evil':
+                self.logger.info(f'I got msg from {m.sender} to {m.dest}. Its prev path: {m.forwarders}. Dropping...')
+            else:
+                m.forwarders.append(self.name)
+                if self.__route__(m):
+                    self.__unicast__(m, m.make())
+
+    def retransmit(self):
+        # resend unicast CUSTOM messages whose ACK did not come in time
+        with self.lock:
+            for key, hop, ifaces, data in self.retransmits.due():
+                self.metrics.inc('custom_retransmits_total')
+                for iface in ifaces:
+                    self.outbox.send(iface, data)
+            self.outbox.flush()
+
+    def __commit__(self, changed):
+        with self.lock:
+            if self.mpr_selector.dirty:
+                self.update_MPRs()
+                changed = True
+            if changed:
+                self.update_neighbors()
+                self.update_MPR_set()
+                if self.__advertisement_changed__():
+                    self.__trigger__()
+            # relays queued while applying the batch go out bundled
+            self.outbox.flush()
+
+    def __update_neighbor__(self, sender, addr, neighbors):
+        # Apply a HELLO to the 1-hop entry of its sender, True if anything
+        # advertised in our own HELLO/TC has to change because of it.
+        # neighbors is None if the HELLO was a delta we could not apply.
+        data = self.network_graph.data(sender) if sender in self.network_graph else {}
+        known_addr = data.get('addr') or []
+        # if me in sender's neighbors and he marked me as a MPR - mark him as mprss
+        if neighbors is None:
+            mprss = bool(data.get('mprss'))
+        else:
+            mprss = any(nbr['name'] == self.name and nbr.get('local_mpr') for nbr in neighbors)
+        changed = addr not in known_addr or bool(data.get('mprss')) != mprss
+        if changed:
+            self.network_graph.add_node(sender, addr=known_addr + [addr] if addr not in known_addr else known_addr, mprss=mprss)
+        if neighbors is None:
+            return changed
+        return self.mpr_selector.update(sender, [nbr['name'] for nbr in neighbors]) or changed
+
+    def __withdraw__(self, sender, names):
+        # A full or reconstructed HELLO/TC is the sender's whole advertised
+        # set: links it no longer lists are dropped right away, unless the
+        # other end still advertises them. Hold times only catch senders
+        # that go silent.
+        for name in names:
+            if name != self.name and not self.received.advertises(name, sender):
+                self.__remove_edge__(sender, name)
+
+    def __resync__(self):
+        # a neighbor lost the delta chain of our HELLO/TC, send both in full soon
+        self.resync.update(('HELLO', 'TC'))
+        self.__trigger__()
 
     def update_topology(self):
-        Broadcaster(
-            message.MessageHandler().hello_message(self.name, self.neighbor_table),
-            interfaces=self.local_interfaces.keys(),
-            broadcast_port=self.broadcast_port,
-            logger=self.logger).run(True)
-        Listerner(
-            self.local_interfaces.keys(),
-            self.broadcast_port,
-            logger=self.logger,
-            handler=self.__update_topology__).run(True)
-        Broadcaster(
-            message.MessageHandler().tc_message(self.name, self.mpr_set),
-            interfaces=self.local_interfaces.keys(),
-            msg_send_callback=self.is_am_MPR,
-            broadcast_port=self.broadcast_port,
-            logger=self.logger).run()
+        if self.transport.simulated:
+            # the mesh drives emission through emit_hello/emit_tc
+            self.transport.listen(self.__update_topology__)
+            return
+        if isinstance(self.transport, AsyncioTransport):
+            self.transport.listen(self.__receive__)
+        else:
+            Listerner(
+                self.local_interfaces.keys(),
+                self.broadcast_port,
+                logger=self.logger,
+                handler=self.__receive__,
+                transport=self.transport).run(True)
+        self.scheduler.start()
+
+    def __schedule__(self):
+        # Simulations leave emission to the mesh driver but may still run
+        # these by calling scheduler.run() in virtual time.
+        self.scheduler.every('emit', self.__emit_interval__, self.emit,
+                             delay=self.scheduler.rng.uniform(0, self.min_interval))
+        self.scheduler.every('expire', self.link_timers.tick, self.expire, jitter=False)
+        self.scheduler.every('retransmit', self.retransmits.timeout, self.retransmit, jitter=False)
+        if self.metrics_dump_every:
+            self.scheduler.every('dump_metrics', self.metrics_dump_every, self.dump_metrics)
+        if self.state_save_every:
+            self.scheduler.every('save_state', self.state_save_every, self.save_state)
+
+    def __emit_interval__(self):
+        # the interval until the next emission, doubled for the one after
+        interval = self.emit_interval
+        if self.adaptive_intervals:
+            self.emit_interval = min(2 * interval, self.max_interval)
+        return interval
+
+    def __advertisement_changed__(self):
+        # whether the next HELLO/TC would differ from the last one sent
+        if {x['name']: x for x in self.neighbor_table} != self.advertised['HELLO'].entries:
+            return True
+        return self.is_am_MPR() and {x['name']: x for x in self.mpr_set} != self.advertised['TC'].entries
+
+    def __trigger__(self):
+        # neighborhood or MPR change: emit soon, then back off again
+        if self.adaptive_intervals:
+            self.emit_interval = self.min_interval
+            self.scheduler.expedite('emit', self.scheduler.jittered(self.min_interval))
+
+    def dump_metrics(self, path=None):
+        self.metrics.dump(path if path else f'artifacts/{self.name}-metrics.json')
+
+    # Sequence numbers sent after the last save are unknown on restart, the
+    # restored counter skips this many so neighbors do not drop our new
+    # messages as duplicates of old ones.
+    SEQ_MARGIN = 1024
+
+    def save_state(self, path=None):
+        with self.lock:
+            nodes = [(x, self.get_data(x)) for x in self.network_graph]
+            edges = list(self.network_graph.edges())
+            ansn = {k: v.ansn for k, v in self.advertised.items()}
+            seq = self.seq
+        TopologyState.save(path if path else self.state_file, nodes, edges, seq, ansn)
+
+    def restore_state(self, path=None):
+        # Load a saved snapshot into the empty graph. Its links get a fresh
+        # hold time and stay in self.stale until a HELLO/TC refreshes them,
+        # otherwise they expire like any other link. Stale links are used for
+        # routing only: they are not advertised, and MPR flags are left to be
+        # learned from HELLOs again. True if loaded.
+        path = path if path else self.state_file
+        try:
+            state = TopologyState.load(path)
+        except Exception as e:
+            self.logger.error(f'Unable to load state from {path}: {e}')
+            return False
+        if state is None:
+            return False
+        if time.time() - state['saved'] > self.state_max_age:
+            self.logger.info(f'Ignoring state from {path}, saved {time.time() - state["saved"]:.0f}s ago')
+            return False
+        with self.lock:
+            for name, attrs in state['nodes']:
+                if name != self.name:
+                    attrs = {x: attrs[x] for x in ('addr', 'mpr') if x in attrs}
+                    self.network_graph.add_node(name, **attrs)
+            for u, v in state['edges']:
+                hold_time = self.neighbor_hold_time if self.name in (u, v) else self.topology_hold_time
+                self.__add_edge__(u, v, hold_time)
+                self.stale.add((u, v) if u < v else (v, u))
+            self.seq = (state['seq'] + self.SEQ_MARGIN) & 0xFFFF
+            for message_type, ansn in state['ansn'].items():
+                self.advertised[message_type].ansn = ansn
+            self.__commit__(True)
+        self.logger.info(f'Restored {len(state["nodes"])} nodes and {len(state["edges"])} links from {path}')
+        return True
 
-    def visualize_network(self, with_mpr=False, image_postfix=None):
-        plt.clf()
-        plt.plot()
-        plt.axis('off')
+    def __next_seq__(self):
+        self.seq = (self.seq + 1) & 0xFFFF
+        return self.seq
+
+    def __originate__(self, msg):
+        # stamp an own message with the next sequence number and remember it,
+        # so copies relayed back to us are dropped as duplicates
         with self.lock:
-            if with_mpr:
-                color_map = []
-                for node in self.network_graph:
-                    if node in self.get_by('local_mpr'):
-                        color_map.append('red')
-                    elif node in self.get_by('mpr'):
-                        color_map.append('green')
-                    else:
-                        color_map.append('blue')
-                self.visualize_method(self.network_graph, node_color=color_map, with_labels=True)
-            else:
-                self.visualize_method(self.network_graph, with_labels=True)
+            msg.seq = self.__next_seq__()
+            self.duplicates.add(self.name, msg.message_type, msg.seq)
+            return msg.make()
+
+    def __advertise__(self, message_type, entries):
+        # build the next HELLO/TC: a delta against the previous emission
+        # when possible, otherwise the full advertised set
+        advertised = self.advertised[message_type]
+        new_names = {x['name'] for x in entries} - set(advertised.entries)
+        advertised.update(entries)
+        last = self.sent_ansn[message_type]
+        delta = None
+        # a new neighbor has no state to apply a delta to, send it everything
+        if last is not None and self.emitted[message_type] % self.full_snapshot_every \
+                and not (message_type == 'HELLO' and new_names) and message_type not in self.resync:
+            delta = advertised.delta_since(last)
+        self.resync.discard(message_type)
+        if delta is None:
+            entries, removed, base_ansn = list(advertised.entries.values()), [], None
+        else:
+            (entries, removed), base_ansn = delta, last
+        self.sent_ansn[message_type] = advertised.ansn
+        self.emitted[message_type] += 1
+        if message_type == 'HELLO':
+            return message.MessageHandler().hello_message(
+                self.name, entries, ansn=advertised.ansn, base_ansn=base_ansn, removed=removed)
+        return message.MessageHandler().tc_message(
+            self.name, entries, ansn=advertised.ansn, base_ansn=base_ansn, removed=removed)
+
+    def emit_hello(self, flush=True):
+        with self.lock:
+            self.hello = self.__advertise__('HELLO', self.neighbor_table)
+            self.outbox.broadcast(self.__originate__(self.hello))
+            if flush:
+                self.outbox.flush()
+
+    def emit_tc(self, flush=True):
+        with self.lock:
+            if self.is_am_MPR():
+                self.tc = self.__advertise__('TC', self.mpr_set)
+                self.outbox.broadcast(self.__originate__(self.tc))
+            if flush:
+                self.outbox.flush()
+
+    def emit(self):
+        # periodic emission: HELLO and TC share datagrams
+        with self.lock:
+            self.emit_hello(flush=False)
+            self.emit_tc(flush=False)
+            self.outbox.flush()
+
+    def __snapshot__(self, kind, path):
+        with self.lock:
+            return {
+                # wall clock: the node clock is monotonic or virtual and
+                # means nothing outside this process
+                't': time.time(),
+                'node': self.name,
+                'kind': kind,
+                'nodes': list(self.network_graph),
+                'edges': self.network_graph.edges(),
+                'mode': self.visualize_mode,
+                'path': path,
+            }
+
+    def visualize_network(self, with_mpr=False, image_postfix=None):
+        # a Future of the image path drawn by the worker process, or the
+        # snapshot file the snapshot was appended to
         if isinstance(image_postfix, int):
             image_name = f'artifacts/{self.name}-{image_postfix}.png'
         else:
             image_name = f'artifacts/{self.name}.png'
-        plt.savefig(image_name)
+        snapshot = self.__snapshot__('network', image_name)
+        if with_mpr:
+            with self.lock:
+                colors = {x: 'green' for x in self.get_by('mpr')}
+                colors.update({x: 'red' for x in self.get_by('local_mpr')})
+            snapshot['node_colors'] = colors
+        return self.__render__(snapshot)
 
     def visualize_route(self, route):
-        def_col = 'b'
-        copy_graph = copy(self.network_graph)
-        plt.clf()
-        plt.plot()
-        plt.axis('off')
-        start_node = route[0]
-        for hop in route[1:]:
-            copy_graph.edges[start_node, hop]['color'] = 'r'
-            start_node = hop
-        edges_color = []
-        for x in copy_graph.edges().data():
-            if(col := x[2].get('color')):
-                edges_color.append(col)
-            else:
-                edges_color.append(def_col)
-        self.visualize_method(self.network_graph, with_labels=True, edge_color=edges_color)
-        plt.savefig(f'artifacts/{self.name}-route.png')
+        snapshot = self.__snapshot__('route', f'artifacts/{self.name}-route.png')
+        snapshot['route'] = list(route)
+        return self.__render__(snapshot)
+
+    def __render__(self, snapshot):
+        if self.render_mode == 'snapshot':
+            os.makedirs(os.path.join('artifacts', 'snapshots'), exist_ok=True)
+            path = os.path.join('artifacts', 'snapshots', f'{self.name}.jsonl')
+            with open(path, 'a') as f:
+                f.write(render.encode(snapshot) + '\n')
+            return path
+
+        def done(future):
+            if future.exception():
+                self.logger.error(f'Unable to render {snapshot["path"]}: {future.exception()}')
+        future = render.submit(snapshot)
+        future.add_done_callback(done)
+        return future
 
     def get_data(self, node):
-        return self.network_graph.nodes().data()[node]
+        return self.network_graph.data(node)
 
     def get_by(self, arg) -> list:
         # return: ['node13', 'node14', 'node15', ...]
-        return [x[0] for x in self.network_graph.nodes().data() if x[1].get(arg)]
+        return self.network_graph.nodes_with(arg)
 
     def update_neighbors(self):
         self.neighbor_table.clear()
         for nbr in list(self.network_graph.neighbors(self.name)): 
+            if ((self.name, nbr) if self.name < nbr else (nbr, self.name)) in self.stale:
+                continue  # restored, not heard from yet
             self.neighbor_table.append({ 
                 'name': nbr,
-                'addr': self.get_data(nbr)['addr'],
+                'addr': self.get_data(nbr).get('addr', []),
                 'local_mpr': True if self.get_data(nbr).get('local_mpr') else False,
-                'mprss': True if self.get_data(nbr).get('mprss') else False
+                'mprss': True if self.get_data(nbr).get('mprss') else False,
+                'resync': self.received.gapped(nbr)
             })
 
     def update_MPR_set(self):
@@ -285,62 +748,54 @@ class Node:
         for node in self.get_by("mprss"):
             self.mpr_set.append({
                     'name': node,
-                    'addr': self.get_data(node)
+                    'addr': self.get_data(node).get('addr', [])
                 })
 
     def update_MPRs(self):
-        self.update_neighbors()
-        any_in = lambda a, b: any(i in b for i in a)
+        # recomputes only if a HELLO changed the 1-hop/2-hop neighborhood
+        old_mprs = self.mpr_selector.mprs
+        with self.metrics.timer('mpr_select_seconds'):
+            mpr_set = self.mpr_selector.select()
 
-        nodes_1 = self.get_neighbors()
-        nodes_2 = self.get_neighbors(dist=2)
-
-        mpr_set = []
-
-        # clean existing mpr set
-        for node in self.network_graph:
-            if self.get_data(node).get('local_mpr'):
+        # self.logger.info(f'My MPRs is {mpr_set}')
+        for node in old_mprs - mpr_set:
+            if node in self.network_graph:
                 self.network_graph.add_node(node, local_mpr=False)
+        for node in mpr_set - old_mprs:
+            self.network_graph.add_node(node, local_mpr=True)
 
-        while nodes_2:
-            node_1_dict = {}
-            for n in nodes_1:
-                # all two my 2-neighbors
-                node_1_dict[n] = [x for x in list(self.network_graph.neighbors(n))
-                                  if x in nodes_2 and x != self.name]
-
-            node_1_dict = {x: node_1_dict[x] for x in sorted(
-                                                            node_1_dict,
-                                                            key=lambda k: len(node_1_dict[k]),
-                                                            reverse=True)}
-            mpr = next(iter(node_1_dict)) # first in sorted dict
-            mpr_set.append(mpr)
-
-            nodes_2 = [x for x in nodes_2 if x not in node_1_dict[mpr]]
-
-            upd_nodes_1_dict = [x for x in nodes_1 if x not in mpr_set]
-            nodes_1 = [x for x in upd_nodes_1_dict if any_in(nodes_2, node_1_dict[x])]
+    def get_route(self, dest_node):
+        with self.lock:
+            return self.routing_table.route(dest_node)
 
-        # self.logger.info(f'My MPRs is {mpr_set}')
-        for node in self.network_graph:
-            if node in mpr_set:
-                self.network_graph.add_node(node, local_mpr=True)
+    def get_routes(self, dest_nodes):
+        # {dest: path}, one table lookup per destination
+        with self.lock:
+            return self.routing_table.routes(dest_nodes)
 
-    def get_route(self, dest_node):
-        if dest_node not in self.network_graph.nodes():
-            return []
-        return nx.shortest_path(self.network_graph, self.name, dest_node)
+    def get_next_hops(self, dest_nodes):
+        with self.lock:
+            return self.routing_table.next_hops(dest_nodes)
 
-    def send_message(self, msg, dest_node):
+    def send_message(self, msg, dest_node, mode=None, ack=None):
+        # mode and ack default to custom_forwarding and custom_ack, returns
+        # False if a unicast message has no next hop
+        mode = mode if mode else self.custom_forwarding
+        ack = self.custom_ack if ack is None else ack
         path = self.get_route(dest_node)
         self.logger.info(f'Sending "{msg}" to {dest_node}. Expected path: {path}')
-        Broadcaster(
-            message.MessageHandler().custom_message(self.name, dest_node, msg),
-            self.local_interfaces.keys(),
-            broadcast_port=self.broadcast_port,
-            broadcast_time=5,
-            logger=self.logger,
-        ).run(background=True)
+        if mode == 'flood':
+            self.outbox.broadcast(self.__originate__(message.MessageHandler().custom_message(self.name, dest_node, msg)))
+            self.outbox.flush()
+            return True
+        m = message.MessageHandler().custom_message(
+            self.name, dest_node, msg, route=path if mode == 'source_route' else None, ack=ack)
+        with self.lock:
+            sent = self.__route__(m)
+            if sent:
+                self.__unicast__(m, self.__originate__(m))
+        self.outbox.flush()
+        return sent
 
     # def __ips__(self, data, addr):
     #     pass
@@ -0,0 +1,92 @@
+import struct
+import threading
+from message import Codec
+
+
+class Packet:
+    # Several encoded messages bundled into one datagram:
+    #
+    #   magic(B) count(B) then count times: length(H) message
+    #
+    # A datagram carrying a single message is sent bare (message.Codec
+    # format, whose magic differs), so split() accepts both.
+    MAGIC = 0x50
+    HEADER = struct.Struct('!BB')
+    LENGTH = struct.Struct('!H')
+    MAX_MESSAGES = 255
+
+    @classmethod
+    def pack(cls, messages, mtu):
+        # greedily fill datagrams up to mtu bytes, in order
+        datagrams, bundle, size = [], [], cls.HEADER.size
+        for msg in messages:
+            need = cls.LENGTH.size + len(msg)
+            if bundle and (size + need > mtu or len(bundle) == cls.MAX_MESSAGES):
+                datagrams.append(cls.__bundle__(bundle))
+                bundle, size = [], cls.HEADER.size
+            bundle.append(msg)
+            size += need
+        if bundle:
+            datagrams.append(cls.__bundle__(bundle))
+        return datagrams
+
+    @classmethod
+    def __bundle__(cls, bundle):
+        if len(bundle) == 1:
+            return bundle[0]
+        out = bytearray(cls.HEADER.pack(cls.MAGIC, len(bundle)))
+        for msg in bundle:
+            out += cls.LENGTH.pack(len(msg))
+            out += msg
+        return bytes(out)
+
+    @classmethod
+    def split(cls, data):
+        view = memoryview(data)
+        if not len(view) or view[0] != cls.MAGIC:
+            return [view]
+        _, count = cls.HEADER.unpack_from(view, 0)
+        offset, messages = cls.HEADER.size, []
+        for _ in range(count):
+            size, = cls.LENGTH.unpack_from(view, offset)
+            offset += cls.LENGTH.size
+            messages.append(view[offset:offset + size])
+            offset += size
+        return messages
+
+
+class Outbox:
+    # Collects messages per interface and sends them as few datagrams as
+    # the MTU allows on flush(). Thread-safe: relays are queued from the
+    # update worker while periodic emission runs elsewhere.
+    def __init__(self, transport, mtu=1472, metrics=None):
+        self.transport = transport
+        self.mtu = mtu
+        self.metrics = metrics
+        self.pending = {}  # iface -> [encoded message, ...]
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.datagrams = 0
+
+    def send(self, iface, data):
+        with self.lock:
+            self.pending.setdefault(iface, []).append(data)
+
+    def broadcast(self, data):
+        for iface in self.transport.local_interfaces:
+            self.send(iface, data)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for iface, messages in pending.items():
+            datagrams = Packet.pack(messages, self.mtu)
+            self.messages += len(messages)
+            self.datagrams += len(datagrams)
+            if self.metrics:
+                for data in messages:
+                    self.metrics.inc('tx_messages_total', type=Codec.TYPE_NAMES.get(data[2]), iface=iface)
+                self.metrics.inc('tx_datagrams_total', len(datagrams), iface=iface)
+                self.metrics.inc('tx_bytes_total', sum(len(x) for x in datagrams), iface=iface)
+            for datagram in datagrams:
+                self.transport.send(iface, datagram)
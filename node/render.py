@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# One worker process per node process, started on the first render. It is
+# spawned rather than forked, so neither the packet handling threads nor
+# matplotlib end up in the wrong process.
+executor = None
+
+
+def submit(snapshot):
+    # snapshot: plain data only, see draw(); returns a Future of the path
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'))
+    return executor.submit(draw, snapshot)
+
+
+def draw(snapshot):
+    # Runs in the worker: matplotlib and networkx are imported here only.
+    # snapshot keys: nodes, edges, path and optionally mode (networkx draw_*
+    # suffix), pos ({node: [x, y]}, overrides mode), node_colors
+    # ({node: color}) and route (path drawn in red).
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import networkx as nx
+    graph = nx.Graph()
+    graph.add_nodes_from(snapshot['nodes'])
+    graph.add_edges_from(snapshot['edges'])
+    mode = snapshot.get('mode')
+    method = getattr(nx, f'draw_{mode}' if mode else 'draw', nx.draw)
+    args = {'with_labels': True}
+    if snapshot.get('pos'):
+        method = nx.draw
+        args['pos'] = snapshot['pos']
+    if snapshot.get('node_colors'):
+        args['node_color'] = [snapshot['node_colors'].get(x, 'blue') for x in graph]
+    if snapshot.get('route'):
+        route = snapshot['route']
+        hops = {frozenset(x) for x in zip(route, route[1:])}
+        args['edge_color'] = ['r' if frozenset(x) in hops else 'b' for x in graph.edges()]
+    plt.clf()
+    plt.plot()
+    plt.axis('off')
+    method(graph, **args)
+    plt.savefig(snapshot['path'])
+    return snapshot['path']
+
+
+# Snapshots for offline rendering: one JSON line per snapshot, node names
+# listed once and edges, roles and route as indexes into them.
+#
+#   {"t": unix time, "node": name, "kind": "network"|"route", "mode": ...,
+#    "nodes": [...], "edges": [[i, j], ...], "colors": {color: [i, ...]},
+#    "route": [i, ...]}
+
+def encode(snapshot):
+    nodes = snapshot['nodes']
+    index = {x: i for i, x in enumerate(nodes)}
+    record = {k: v for k, v in snapshot.items() if k not in ('nodes', 'edges', 'node_colors', 'route', 'path')}
+    record['nodes'] = nodes
+    record['edges'] = [[index[u], index[v]] for u, v in snapshot['edges']]
+    if snapshot.get('node_colors'):
+        colors = {}
+        for node, color in snapshot['node_colors'].items():
+            if node in index:
+                colors.setdefault(color, []).append(index[node])
+        record['colors'] = colors
+    if snapshot.get('route'):
+        record['route'] = [index[x] for x in snapshot['route'] if x in index]
+    return json.dumps(record, separators=(',', ':'))
+
+
+def decode(line):
+    record = json.loads(line)
+    nodes = record['nodes']
+    snapshot = {k: v for k, v in record.items() if k not in ('edges', 'colors', 'route')}
+    snapshot['edges'] = [(nodes[u], nodes[v]) for u, v in record['edges']]
+    if record.get('colors'):
+        snapshot['node_colors'] = {nodes[i]: color for color, idxs in record['colors'].items() for i in idxs}
+    if record.get('route'):
+        snapshot['route'] = [nodes[i] for i in record['route']]
+    return snapshot
+
+
+def topology_hash(snapshot):
+    edges = sorted(tuple(sorted(x)) for x in snapshot['edges'])
+    data = json.dumps([sorted(snapshot['nodes']), edges], separators=(',', ':'))
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def layout(snapshot):
+    # spring layout with a fixed seed, {node: [x, y]}
+    import networkx as nx
+    graph = nx.Graph()
+    graph.add_nodes_from(sorted(snapshot['nodes']))
+    graph.add_edges_from(sorted(tuple(sorted(x)) for x in snapshot['edges']))
+    return {node: [float(x), float(y)] for node, (x, y) in nx.spring_layout(graph, seed=1).items()}
+
+
+def load(paths):
+    # snapshots from .jsonl files or directories of them, in file order
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, x) for x in os.listdir(path) if x.endswith('.jsonl'))
+        else:
+            files.append(path)
+    for fn in files:
+        with open(fn) as f:
+            for line in f:
+                if line.strip():
+                    yield decode(line)
+
+
+if __name__ == '__main__':
+    # Offline renderer: python render.py artifacts/snapshots [--out dir]
+    argparser = argparse.ArgumentParser(description='Render node snapshots to PNG frames.')
+    argparser.add_argument('snapshots', nargs='+', help='Snapshot .jsonl files or directories')
+    argparser.add_argument('--out', default=os.path.join('artifacts', 'frames'))
+    argparser.add_argument('--layouts', help='Layout cache directory, <out>/layouts by default')
+    argparser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = argparser.parse_args()
+
+    layouts_dir = args.layouts or os.path.join(args.out, 'layouts')
+    os.makedirs(args.out, exist_ok=True)
+    os.makedirs(layouts_dir, exist_ok=True)
+    frames, counts, pending = [], {}, {}
+    for snapshot in load(args.snapshots):
+        key = (snapshot.get('node'), snapshot.get('kind'))
+        counts[key] = counts.get(key, -1) + 1
+        snapshot['path'] = os.path.join(args.out, f'{key[0]}-{key[1]}-{counts[key]:06d}.png')
+        snapshot['hash'] = digest = topology_hash(snapshot)
+        if digest not in pending and not os.path.exists(os.path.join(layouts_dir, f'{digest}.json')):
+            pending[digest] = snapshot
+        frames.append(snapshot)
+
+    with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        # one layout per distinct topology, then every frame reuses it
+        for digest, pos in zip(pending, pool.map(layout, pending.values())):
+            with open(os.path.join(layouts_dir, f'{digest}.json'), 'w') as f:
+                json.dump(pos, f)
+        layouts = {}
+        for snapshot in frames:
+            digest = snapshot['hash']
+            if digest not in layouts:
+                with open(os.path.join(layouts_dir, f'{digest}.json')) as f:
+                    layouts[digest] = json.load(f)
+            snapshot['pos'] = layouts[digest]
+        for path in pool.map(draw, frames, chunksize=16):
+            pass
+    print(f'{len(frames)} frames, {len(pending)} new layouts of {len(layouts)} topologies', file=sys.stderr)
@@ -0,0 +1,65 @@
+class RoutingTable:
+    # Shortest paths from one node to every reachable destination, built with
+    # a single BFS and reused until the topology epoch (DistanceIndex.version)
+    # moves. The rebuild happens on the first lookup after a change.
+    def __init__(self, graph, distances, source, metrics=None):
+        self.graph = graph
+        self.metrics = metrics
+        self.distances = distances
+        self.source = source
+        self.epoch = None
+        self.parents = {}
+        self.hops = {}  # destination -> first hop from source
+        self.paths = {}
+
+    def __build__(self):
+        parents = {self.source: None}
+        hops = {self.source: self.source}
+        frontier = [self.source]
+        while frontier:
+            layer = []
+            for node in frontier:
+                for nbr in self.graph.neighbors(node):
+                    if nbr not in parents:
+                        parents[nbr] = node
+                        hops[nbr] = nbr if node == self.source else hops[node]
+                        layer.append(nbr)
+            frontier = layer
+        self.parents = parents
+        self.hops = hops
+        self.paths = {}
+        self.epoch = self.distances.version
+
+    def __fresh__(self):
+        if self.epoch != self.distances.version or self.source not in self.parents:
+            if self.metrics:
+                with self.metrics.timer('route_rebuild_seconds'):
+                    self.__build__()
+            else:
+                self.__build__()
+
+    def route(self, dest):
+        self.__fresh__()
+        if dest not in self.parents:
+            return []
+        # walk up to the closest destination whose path is already known
+        chain, node = [], dest
+        while node is not None and node not in self.paths:
+            chain.append(node)
+            node = self.parents[node]
+        path = self.paths[node] if node is not None else []
+        for node in reversed(chain):
+            path = path + [node]
+            self.paths[node] = path
+        return list(self.paths[dest])
+
+    def next_hop(self, dest):
+        self.__fresh__()
+        return self.hops.get(dest)
+
+    def routes(self, dests):
+        return {dest: self.route(dest) for dest in dests}
+
+    def next_hops(self, dests):
+        self.__fresh__()
+        return {dest: self.hops.get(dest) for dest in dests}
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+from transport import UdpTransport
+
+
+class Receiver(asyncio.DatagramProtocol):
+    def __init__(self, handler, iface_for, logger=None):
+        self.handler = handler
+        self.iface_for = iface_for
+        self.logger = logger
+
+    def datagram_received(self, data, addr):
+        try:
+            self.handler(data, addr[0], self.iface_for(addr[0]))
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f'Unable to handle datagram from {addr[0]}: {e}')
+
+
+class AsyncioTransport(UdpTransport):
+    # UDP transport running on a single asyncio event loop: one receive
+    # endpoint for all interfaces and one send endpoint per interface. The
+    # loop lives in one background thread, so the thread count does not
+    # depend on interfaces or relays; timers are left to the node's
+    # Scheduler.
+    simulated = False
+
+    def __init__(self, port=37020, interface_pattern='eth', logger=None):
+        super().__init__(port, interface_pattern)
+        self.logger = logger
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='event_loop', daemon=True)
+        self.thread.start()
+        self.endpoints = {}
+        self.receiver = None
+        self.__run__(self.__open_endpoints__())
+
+    def __run__(self, coro):
+        # run a coroutine on the loop from any other thread and wait for it
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def __open_endpoints__(self):
+        for iface in self.local_interfaces:
+            sock = self.__send_socket__(iface)
+            sock.setblocking(False)
+            self.endpoints[iface], _ = await self.loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, sock=sock)
+
+    def __in_loop__(self):
+        return threading.current_thread() is self.thread
+
+    def listen(self, handler):
+        async def open_receiver():
+            sock = self.listen_socket(None)
+            sock.setblocking(False)
+            self.receiver, _ = await self.loop.create_datagram_endpoint(
+                lambda: Receiver(handler, self.iface_for, self.logger), sock=sock)
+        self.__run__(open_receiver())
+
+    def send(self, iface, data):
+        if self.__in_loop__():
+            self.endpoints[iface].sendto(data, (self.UDP_IP, self.PORT))
+        else:
+            self.loop.call_soon_threadsafe(self.send, iface, data)
+
+    def close(self):
+        async def shutdown():
+            tasks = [x for x in asyncio.all_tasks() if x is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for endpoint in list(self.endpoints.values()) + [self.receiver]:
+                if endpoint:
+                    endpoint.close()
+        self.__run__(shutdown())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.send_sockets.clear()
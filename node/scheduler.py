@@ -0,0 +1,119 @@
+import time
+import heapq
+import random
+import threading
+
+
+class Scheduler:
+    # One timer heap per node for all its periodic and one-shot jobs. Jobs
+    # are keyed; moving a job leaves its old heap entry behind and run()
+    # skips entries whose generation is no longer current, so scheduling
+    # and moving are both O(log n). Periodic intervals are jittered as in
+    # RFC 3626 (MAXJITTER): shortened by a random part of up to jitter *
+    # interval, so nodes started together do not emit in lockstep. A live
+    # node runs the jobs on the scheduler's own thread (start), simulations
+    # call run() in virtual time instead.
+    def __init__(self, clock=time.monotonic, jitter=0.25, rng=None, logger=None):
+        self.clock = clock
+        self.jitter = jitter
+        self.rng = rng if rng else random.Random()
+        self.logger = logger
+        self.heap = []  # (deadline, generation, key)
+        self.jobs = {}  # key -> [callback, interval, jittered, generation, deadline]
+        self.generation = 0
+        self.lock = threading.Condition()  # notified when a job moves earlier
+        self.thread = None
+
+    def __push__(self, key, job, deadline):
+        self.generation += 1
+        job[3], job[4] = self.generation, deadline
+        heapq.heappush(self.heap, (deadline, self.generation, key))
+        self.lock.notify()
+
+    def jittered(self, interval):
+        return interval - self.rng.uniform(0, self.jitter * interval)
+
+    def every(self, key, interval, callback, delay=None, jitter=True):
+        # interval is seconds or a callable returning the next interval,
+        # asked after every run; the first run is after delay (one jittered
+        # interval if None)
+        with self.lock:
+            job = [callback, interval, jitter, 0, 0]
+            self.jobs[key] = job
+            if delay is None:
+                delay = self.__interval__(job)
+            self.__push__(key, job, self.clock() + delay)
+
+    def after(self, key, delay, callback):
+        # one-shot job, replaces a pending job with the same key
+        with self.lock:
+            job = [callback, None, False, 0, 0]
+            self.jobs[key] = job
+            self.__push__(key, job, self.clock() + delay)
+
+    def expedite(self, key, delay):
+        # run a job no later than delay from now, True if it was moved
+        with self.lock:
+            job = self.jobs.get(key)
+            deadline = self.clock() + delay
+            if job is None or job[4] <= deadline:
+                return False
+            self.__push__(key, job, deadline)
+            return True
+
+    def __next_deadline__(self):
+        while self.heap:
+            deadline, generation, key = self.heap[0]
+            job = self.jobs.get(key)
+            if job is not None and job[3] == generation:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def __interval__(self, job):
+        interval = job[1]() if callable(job[1]) else job[1]
+        return self.jittered(interval) if job[2] else interval
+
+    def run(self):
+        # runs every job that is due, returns how many ran
+        now = self.clock()
+        ran = 0
+        while True:
+            with self.lock:
+                if not self.heap or self.heap[0][0] > now:
+                    return ran
+                deadline, generation, key = heapq.heappop(self.heap)
+                job = self.jobs.get(key)
+                if job is None or job[3] != generation:
+                    continue
+                if job[1] is None:
+                    del self.jobs[key]
+            try:
+                job[0]()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f'Scheduled {key} failed: {e}')
+            ran += 1
+            if job[1] is not None:
+                with self.lock:
+                    # unless replaced while it ran
+                    if self.jobs.get(key) is job and job[3] == generation:
+                        self.__push__(key, job, self.clock() + self.__interval__(job))
+
+    def run_forever(self):
+        while True:
+            self.run()
+            with self.lock:
+                deadline = self.__next_deadline__()
+                if deadline is None:
+                    self.lock.wait()
+                elif deadline > self.clock():
+                    self.lock.wait(deadline - self.clock())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run_forever, name='scheduler', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def __len__(self):
+        return len(self.jobs)
@@ -0,0 +1,330 @@
+import os
+import sys
+import math
+import time
+import socket
+import struct
+import logging
+import multiprocessing
+from collections import deque, defaultdict
+from multiprocessing import shared_memory
+from simulation import Simulation
+from transport import SimulatedMesh
+
+
+class RingBuffer:
+    # Single producer, single consumer queue of datagrams in a SharedMemory
+    # block. The header holds two byte counters that only grow: head is
+    # written by the consumer only, tail by the producer only, so neither
+    # side needs a lock. Records may wrap around the end of the block.
+    HEADER = struct.Struct('=QQ')  # head, tail
+    RECORD = struct.Struct('=I4sH')  # network id, sender address, length
+
+    def __init__(self, name=None, size=1 << 20):
+        if name:
+            self.shm = shared_memory.SharedMemory(name)
+        else:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER.size + size)
+            self.HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.capacity = self.shm.size - self.HEADER.size
+
+    def __write__(self, pos, data):
+        pos %= self.capacity
+        first = min(len(data), self.capacity - pos)
+        start = self.HEADER.size
+        self.buf[start + pos:start + pos + first] = data[:first]
+        if first < len(data):
+            self.buf[start:start + len(data) - first] = data[first:]
+
+    def __read__(self, pos, size):
+        pos %= self.capacity
+        first = min(size, self.capacity - pos)
+        start = self.HEADER.size
+        data = bytes(self.buf[start + pos:start + pos + first])
+        if first < size:
+            data += bytes(self.buf[start:start + size - first])
+        return data
+
+    def put(self, network, addr, data):
+        # False if there is no room right now
+        head, tail = self.HEADER.unpack_from(self.buf, 0)
+        size = self.RECORD.size + len(data)
+        if size > self.capacity:
+            raise ValueError(f'Datagram of {len(data)} bytes does not fit a ring of {self.capacity}')
+        if self.capacity - (tail - head) < size:
+            return False
+        self.__write__(tail, self.RECORD.pack(network, addr, len(data)) + data)
+        struct.pack_into('=Q', self.buf, 8, tail + size)
+        return True
+
+    def get_all(self):
+        head, tail = self.HEADER.unpack_from(self.buf, 0)
+        records = []
+        while head < tail:
+            network, addr, size = self.RECORD.unpack(self.__read__(head, self.RECORD.size))
+            records.append((network, addr, self.__read__(head + self.RECORD.size, size)))
+            head += self.RECORD.size + size
+        struct.pack_into('=Q', self.buf, 0, head)
+        return records
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class RemoteEndpoint:
+    # Sender of a datagram that came from another shard, shaped like a
+    # MemoryTransport as far as SimulatedMesh.run() is concerned.
+    def __init__(self, network, addr):
+        self.networks = {'remote': network}
+        self.local_interfaces = {'remote': addr}
+
+
+class ShardMesh(SimulatedMesh):
+    # The part of a SimulatedMesh living in one worker process. Broadcasts
+    # on a network that also has members in other shards are copied to the
+    # ring buffer of each of those shards; a full ring keeps the rest in an
+    # overflow queue retried on the next step.
+    def __init__(self, network_ids, remote_shards, outbound, inbound, first_addr=0):
+        super().__init__(first_addr)
+        self.network_ids = network_ids  # network -> id, same in every shard
+        self.network_names = {v: k for k, v in network_ids.items()}
+        self.remote_shards = remote_shards  # network -> other shards with members
+        self.outbound = outbound  # shard -> RingBuffer
+        self.inbound = inbound
+        self.overflow = deque()  # (shard, network id, addr, data)
+        self.remote = {}  # (network, addr) -> RemoteEndpoint
+        self.sent = 0
+        self.received = 0
+
+    def deliver(self, transport, iface, data):
+        super().deliver(transport, iface, data)
+        network = transport.networks[iface]
+        shards = self.remote_shards.get(network)
+        if shards:
+            addr = socket.inet_aton(transport.local_interfaces[iface])
+            for shard in shards:
+                self.overflow.append((shard, self.network_ids[network], addr, data))
+                self.sent += 1
+            self.__push__()
+
+    def __push__(self):
+        while self.overflow:
+            shard, network, addr, data = self.overflow[0]
+            if not self.outbound[shard].put(network, addr, data):
+                break
+            self.overflow.popleft()
+
+    def receive(self):
+        for ring in self.inbound:
+            for network_id, addr, data in ring.get_all():
+                network = self.network_names[network_id]
+                addr = socket.inet_ntoa(addr)
+                sender = self.remote.get((network, addr))
+                if sender is None:
+                    sender = self.remote[network, addr] = RemoteEndpoint(network, addr)
+                self.queue.append((sender, 'remote', data))
+                self.received += 1
+
+    def step(self, max_datagrams=None):
+        # returns how many queued datagrams were handled
+        self.receive()
+        handled = self.run(max_datagrams)
+        self.__push__()
+        return handled
+
+    def status(self):
+        return self.sent, self.received, len(self.queue), len(self.overflow), self.flushed
+
+
+def partition(configs, parts):
+    # Nodes in breadth-first order over shared networks, cut in equal
+    # chunks: neighbors mostly land in the same shard.
+    by_network = defaultdict(list)
+    for cfg in configs:
+        for network in cfg['networks']:
+            by_network[network].append(cfg)
+    order, seen = [], set()
+    for cfg in configs:
+        if cfg['name'] in seen:
+            continue
+        seen.add(cfg['name'])
+        queue = deque([cfg])
+        while queue:
+            cfg = queue.popleft()
+            order.append(cfg)
+            for network in cfg['networks']:
+                for other in by_network[network]:
+                    if other['name'] not in seen:
+                        seen.add(other['name'])
+                        queue.append(other)
+    size = math.ceil(len(order) / parts) if order else 1
+    return [order[i:i + size] for i in range(0, len(order), size)]
+
+
+def worker(shard, configs, network_ids, remote_shards, outbound, inbound, first_addr, overrides, conn):
+    logger = logging.getLogger(f'shard{shard}')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    outbound = {x: RingBuffer(name) for x, name in outbound.items()}
+    inbound = [RingBuffer(name) for name in inbound]
+    mesh = ShardMesh(network_ids, remote_shards, outbound, inbound, first_addr)
+    sim = Simulation(configs, logger=logger, mesh=mesh, **overrides)
+    budget = 0
+    while True:
+        command, args = conn.recv()
+        if command == 'emit':
+            mesh.now += args
+            for node in sim.nodes.values():
+                node.expire()
+                node.retransmit()
+            for node in sim.nodes.values():
+                node.emit()
+            budget = sim.datagram_budget * len(sim.nodes) if sim.datagram_budget else None
+            conn.send(None)
+        elif command == 'step':
+            handled = mesh.step(budget)
+            if budget is not None:
+                budget -= handled
+                if budget <= 0:
+                    mesh.flush()
+            conn.send(mesh.status())
+        elif command == 'call':
+            name, method, call_args = args
+            try:
+                conn.send((True, getattr(sim.nodes[name], method)(*call_args)))
+            except Exception as e:
+                conn.send((False, e))
+        elif command == 'stats':
+            conn.send({'nodes': len(sim.nodes), 'delivered': mesh.delivered, 'bytes': mesh.bytes,
+                       'dropped': mesh.dropped, 'flushed': mesh.flushed,
+                       'sent': mesh.sent, 'received': mesh.received})
+        elif command == 'stop':
+            for ring in list(outbound.values()) + inbound:
+                ring.close()
+            conn.send(None)
+            return
+
+
+class ShardedSimulation:
+    # Simulation spread over worker processes. Nodes are partitioned with
+    # partition(), every worker runs a Simulation of its part on a
+    # ShardMesh and broadcasts crossing shards go through one shared-memory
+    # ring per ordered pair of shards that share a network. A round is
+    # emission everywhere, then exchange steps until no datagram is queued
+    # or in flight in any shard. overrides go to every worker's Simulation,
+    # with datagram_budget a worker drops what it cannot handle within the
+    # budget; the drops are counted in stats() and logged after the round.
+    def __init__(self, configs, workers=None, ring_size=1 << 20, logger=None, **overrides):
+        self.logger = logger if logger else logging.getLogger('shards')
+        self.shards = partition(configs, workers or os.cpu_count())
+        shard_of = {cfg['name']: idx for idx, part in enumerate(self.shards) for cfg in part}
+        members = defaultdict(set)  # network -> shards
+        for cfg in configs:
+            for network in cfg['networks']:
+                members[network].add(shard_of[cfg['name']])
+        network_ids = {network: idx for idx, network in enumerate(sorted(members))}
+        self.rings = {}  # (src, dst) -> RingBuffer
+        for shards in members.values():
+            for src in shards:
+                for dst in shards - {src}:
+                    if (src, dst) not in self.rings:
+                        self.rings[src, dst] = RingBuffer(size=ring_size)
+        context = multiprocessing.get_context('spawn')
+        self.conns, self.processes = [], []
+        first_addr = 0
+        for idx, part in enumerate(self.shards):
+            remote_shards = {
+                network: sorted(shards - {idx}) for network, shards in members.items()
+                if idx in shards and len(shards) > 1}
+            outbound = {dst: ring.name for (src, dst), ring in self.rings.items() if src == idx}
+            inbound = [ring.name for (src, dst), ring in self.rings.items() if dst == idx]
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=worker, name=f'shard{idx}', daemon=True,
+                args=(idx, part, network_ids, remote_shards, outbound, inbound, first_addr, overrides, child))
+            process.start()
+            self.conns.append(parent)
+            self.processes.append(process)
+            first_addr += sum(len(cfg['networks']) for cfg in part)
+        self.shard_of = shard_of
+        self.steps = 0
+        self.flushed = 0
+
+    def __all__(self, command, args=None):
+        for conn in self.conns:
+            conn.send((command, args))
+        return [conn.recv() for conn in self.conns]
+
+    def round(self, period=30):
+        self.__all__('emit', period)
+        while True:
+            self.steps += 1
+            results = self.__all__('step')
+            sent = sum(x[0] for x in results)
+            received = sum(x[1] for x in results)
+            if sent == received and not any(x[2] or x[3] for x in results):
+                break
+        flushed = sum(x[4] for x in results)
+        if flushed > self.flushed:
+            self.logger.warning(f'Datagram budget exhausted, dropped {flushed - self.flushed} datagrams this round')
+            self.flushed = flushed
+
+    def run(self, rounds):
+        for _ in range(rounds):
+            self.round()
+
+    def call(self, name, method, *args):
+        # run a Node method in the shard owning the node, result is pickled
+        conn = self.conns[self.shard_of[name]]
+        conn.send(('call', (name, method, args)))
+        ok, result = conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def stats(self):
+        return self.__all__('stats')
+
+    def close(self):
+        self.__all__('stop')
+        for process in self.processes:
+            process.join()
+        for ring in self.rings.values():
+            ring.close(unlink=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 4:
+        print('Usage: python shards.py [node-configs dir | topology.edges] [rounds] [workers]')
+        exit(1)
+
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join('..', 'autogen', 'node-configs')
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    configs = SimulatedMesh.load_configs(source) if os.path.isdir(source) else SimulatedMesh.load_edges(source)
+
+    started = time.time()
+    with ShardedSimulation(configs, workers=workers) as sim:
+        print(f'{len(configs)} nodes in {len(sim.shards)} shards, {len(sim.rings)} rings, '
+              f'started in {time.time() - started:.2f}s')
+        for idx in range(rounds):
+            started = time.time()
+            sim.round()
+            stats = sim.stats()
+            print(f'Round {idx}: {time.time() - started:.2f}s, '
+                  f'{sum(x["delivered"] for x in stats)} datagrams delivered, '
+                  f'{sum(x["sent"] for x in stats)} crossed shards, '
+                  f'{sum(x["dropped"] for x in stats)} dropped on down links and '
+                  f'{sum(x["flushed"] for x in stats)} over budget so far')
@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import logging
+from node import Node, create_logger
+from transport import SimulatedMesh
+
+
+class Simulation:
+    # Runs a whole mesh in one process on top of SimulatedMesh. Nodes do not
+    # start any threads, emission is driven round by round from here. Every
+    # round is drained until the mesh is quiet; large meshes relay millions
+    # of TCs per round, so a cap would skew the protocol cost and convergence
+    # numbers.
+
+    def __init__(self, configs, logger=None, mesh=None, datagram_budget=None, **overrides):
+        # overrides are applied to every node config, e.g. topology_store='compact'.
+        # datagram_budget: optional cap on the datagrams handled per round and
+        # node, whatever is left over is dropped with a warning and counted
+        # in mesh.flushed
+        self.mesh = mesh if mesh else SimulatedMesh()
+        self.logger = logger if logger else create_logger('simulation-logger', threads=False)
+        self.datagram_budget = datagram_budget
+        self.overrides = overrides
+        self.nodes = {}
+        for cfg in configs:
+            self.add_node(cfg)
+
+    def add_node(self, cfg):
+        transport = self.mesh.attach(cfg['name'], cfg['networks'])
+        node = self.nodes[cfg['name']] = Node({**cfg, **self.overrides}, transport=transport, logger=self.logger)
+        return node
+
+    @classmethod
+    def from_dir(cls, configs_dir, logger=None, **overrides):
+        return cls(SimulatedMesh.load_configs(configs_dir), logger=logger, **overrides)
+
+    @classmethod
+    def from_edges(cls, path, logger=None, **overrides):
+        return cls(SimulatedMesh.load_edges(path), logger=logger, **overrides)
+
+    def __drain__(self):
+        if not self.datagram_budget:
+            self.mesh.run()
+            return
+        self.mesh.run(self.datagram_budget * len(self.nodes))
+        if self.mesh.queue:
+            flushed = self.mesh.flush()
+            self.logger.warning(f'Datagram budget of {self.datagram_budget} per node exhausted, '
+                                f'dropped {flushed} datagrams still in flight')
+
+    def round(self, period=30):
+        # one broadcast period of virtual time per round
+        self.mesh.now += period
+        for node in self.nodes.values():
+            node.expire()
+            node.retransmit()
+        # HELLO and TC of a node go out bundled, as on a live node
+        for node in self.nodes.values():
+            node.emit()
+        self.__drain__()
+
+    def run(self, rounds):
+        for _ in range(rounds):
+            self.round()
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 3:
+        print('Usage: python simulation.py [node-configs dir | topology.edges] [rounds]')
+        exit(1)
+
+    configs_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join('..', 'autogen', 'node-configs')
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    os.makedirs('artifacts', exist_ok=True)
+    logger = create_logger('simulation-logger', threads=False)
+    logger.setLevel(logging.WARNING)
+
+    started = time.time()
+    if os.path.isdir(configs_dir):
+        sim = Simulation.from_dir(configs_dir, logger=logger)
+    else:
+        sim = Simulation.from_edges(configs_dir, logger=logger)
+    logger.warning(f'Created {len(sim.nodes)} nodes in {time.time() - started:.2f}s')
+    for idx in range(rounds):
+        started = time.time()
+        sim.round()
+        logger.warning(f'Round {idx}: {time.time() - started:.2f}s, '
+                       f'{sim.mesh.delivered} datagrams / {sim.mesh.bytes} bytes delivered, '
+                       f'{sim.mesh.dropped} dropped on down links and {sim.mesh.flushed} over budget so far, '
+                       f'{sum(sum(n.duplicates.suppressed.values()) for n in sim.nodes.values())} duplicates suppressed')
@@ -0,0 +1,82 @@
+import os
+import mmap
+import time
+import socket
+import struct
+
+
+class TopologyState:
+    # Warm-start snapshot of a node: topology, roles, addresses and sequence
+    # state in one compact file read through mmap. Layout, integers in
+    # network byte order:
+    #
+    #   header:  magic(4s) version(B) saved(d) seq(H) hello_ansn(H) tc_ansn(H)
+    #            nodes(I) edges(I) names_len(I) addrs(I)
+    #   names:   node names, NUL separated
+    #   flags:   B per node, bits as in CompactStore.FLAGS
+    #   counts:  B per node, number of its addresses
+    #   addrs:   4 bytes per IPv4 address, in node order
+    #   edges:   I I per edge, indexes into names
+    #
+    # saved is wall-clock time.time(), comparable across reboots and
+    # processes for the staleness check on load.
+    MAGIC = b'OLSS'
+    VERSION = 1
+    HEADER = struct.Struct('!4sBdHHHIIII')
+    FLAGS = {'mprss': 0x01, 'local_mpr': 0x02, 'mpr': 0x04}
+
+    @classmethod
+    def save(cls, path, nodes, edges, seq, ansn):
+        # nodes: [(name, attrs)], edges: [(u, v)], ansn: {'HELLO': n, 'TC': n}
+        index = {name: idx for idx, (name, _) in enumerate(nodes)}
+        names = '\0'.join(name for name, _ in nodes).encode()
+        flags = bytes(sum(bit for attr, bit in cls.FLAGS.items() if data.get(attr)) for _, data in nodes)
+        addrs = [[x for x in data.get('addr') or [] if x][:255] for _, data in nodes]
+        counts = bytes(len(x) for x in addrs)
+        packed = b''.join(socket.inet_aton(x) for node_addrs in addrs for x in node_addrs)
+        edge_ids = struct.pack(f'!{2 * len(edges)}I', *(index[x] for edge in edges for x in edge))
+        header = cls.HEADER.pack(
+            cls.MAGIC, cls.VERSION, time.time(), seq & 0xFFFF, ansn['HELLO'] & 0xFFFF, ansn['TC'] & 0xFFFF,
+            len(nodes), len(edges), len(names), len(packed) // 4)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # written aside and renamed, a crash mid-write leaves the old file
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(header + names + flags + counts + packed + edge_ids)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        # None if there is no usable snapshot
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return None
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            magic, version, saved, seq, hello_ansn, tc_ansn, n_nodes, n_edges, names_len, n_addrs = \
+                cls.HEADER.unpack_from(view, 0)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise Exception(f'Bad state file {path}: magic {magic}, version {version}')
+            offset = cls.HEADER.size
+            names = str(view[offset:offset + names_len], 'utf-8').split('\0') if n_nodes else []
+            offset += names_len
+            flags = view[offset:offset + n_nodes]
+            offset += n_nodes
+            counts = view[offset:offset + n_nodes]
+            offset += n_nodes
+            addrs = [socket.inet_ntoa(view[offset + 4 * i:offset + 4 * i + 4]) for i in range(n_addrs)]
+            offset += 4 * n_addrs
+            edge_ids = struct.unpack_from(f'!{2 * n_edges}I', view, offset)
+        nodes, pos = [], 0
+        for idx, name in enumerate(names):
+            attrs = {attr: bool(flags[idx] & bit) for attr, bit in cls.FLAGS.items()}
+            if counts[idx]:
+                attrs['addr'] = addrs[pos:pos + counts[idx]]
+                pos += counts[idx]
+            nodes.append((name, attrs))
+        edges = [(names[edge_ids[i]], names[edge_ids[i + 1]]) for i in range(0, len(edge_ids), 2)]
+        return {
+            'saved': saved,
+            'seq': seq,
+            'ansn': {'HELLO': hello_ansn, 'TC': tc_ansn},
+            'nodes': nodes,
+            'edges': edges,
+        }
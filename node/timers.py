@@ -0,0 +1,62 @@
+import math
+
+
+class TimerWheel:
+    # Hashed timer wheel for validity times. A key lives in the slot of its
+    # deadline; refreshing moves it to another slot in O(1). advance() visits
+    # only the slots passed since the previous call, and keys whose deadline
+    # lies more than one revolution ahead simply stay in their slot until
+    # the wheel comes around again. Slots are created on first use and
+    # dropped when emptied, so an idle wheel costs next to nothing.
+    def __init__(self, tick=1.0, slots=512, now=0.0):
+        self.tick = tick
+        self.size = slots
+        self.slots = {}  # slot index -> set of keys
+        self.deadlines = {}  # key -> deadline
+        self.position = math.floor(now / tick)
+
+    def __slot_of__(self, deadline):
+        return math.floor(deadline / self.tick) % self.size
+
+    def __discard__(self, key, deadline):
+        idx = self.__slot_of__(deadline)
+        slot = self.slots.get(idx)
+        if slot is not None:
+            slot.discard(key)
+            if not slot:
+                del self.slots[idx]
+
+    def schedule(self, key, deadline):
+        old = self.deadlines.get(key)
+        if old is not None:
+            self.__discard__(key, old)
+        self.deadlines[key] = deadline
+        self.slots.setdefault(self.__slot_of__(deadline), set()).add(key)
+
+    def cancel(self, key):
+        old = self.deadlines.pop(key, None)
+        if old is not None:
+            self.__discard__(key, old)
+
+    def advance(self, now):
+        # returns the keys whose deadline passed, in no particular order
+        expired = []
+        target = math.floor(now / self.tick)
+        # a full revolution visits every slot, no need to go around twice
+        start = max(self.position, target - self.size + 1)
+        for position in range(start, target + 1):
+            idx = position % self.size
+            slot = self.slots.get(idx)
+            if not slot:
+                continue
+            for key in [k for k in slot if self.deadlines[k] <= now]:
+                slot.discard(key)
+                del self.deadlines[key]
+                expired.append(key)
+            if not slot:
+                del self.slots[idx]
+        self.position = target
+        return expired
+
+    def __len__(self):
+        return len(self.deadlines)
@@ -0,0 +1,255 @@
+from array import array
+
+
+class RoleIndex:
+    # Members of every boolean role (MPR selectors, own MPRs, remote MPRs),
+    # maintained on each attribute change so that listing a role costs the
+    # size of the role, not of the graph. Dicts keep insertion order.
+    ROLES = ('mprss', 'local_mpr', 'mpr')
+
+    def __init_roles__(self):
+        self.roles = {x: {} for x in self.ROLES}
+
+    def __update_roles__(self, node, attrs):
+        for attr, value in attrs.items():
+            members = self.roles.get(attr)
+            if members is None:
+                continue
+            if value:
+                members[node] = True
+            else:
+                members.pop(node, None)
+
+    def __drop_roles__(self, node):
+        for members in self.roles.values():
+            members.pop(node, None)
+
+    def any_with(self, role):
+        return bool(self.roles[role])
+
+
+class NetworkxStore(RoleIndex):
+    # Topology store on top of networkx.Graph, node attributes live in the
+    # per-node attribute dicts exactly as before.
+    def __init__(self):
+        import networkx as nx
+        self.graph = nx.Graph()
+        self.__init_roles__()
+
+    def __contains__(self, node):
+        return node in self.graph
+
+    def __iter__(self):
+        return iter(self.graph)
+
+    def __len__(self):
+        return len(self.graph)
+
+    def add_node(self, node, **attrs):
+        self.graph.add_node(node, **attrs)
+        self.__update_roles__(node, attrs)
+
+    def remove_node(self, node):
+        self.graph.remove_node(node)
+        self.__drop_roles__(node)
+
+    def add_edge(self, u, v):
+        self.graph.add_edge(u, v)
+
+    def remove_edge(self, u, v):
+        self.graph.remove_edge(u, v)
+
+    def has_edge(self, u, v):
+        return self.graph.has_edge(u, v)
+
+    def neighbors(self, node):
+        return self.graph.neighbors(node)
+
+    def degree(self, node):
+        return self.graph.degree(node)
+
+    def data(self, node):
+        return self.graph.nodes[node]
+
+    def nodes_with(self, attr):
+        if attr in self.roles:
+            return list(self.roles[attr])
+        return [x for x, data in self.graph.nodes(data=True) if data.get(attr)]
+
+    def edges(self):
+        return list(self.graph.edges())
+
+
+class CompactStore(RoleIndex):
+    # Topology store for large meshes: node names are interned to integer
+    # ids, adjacency is one array('I') of neighbor ids per node and the
+    # boolean roles are bits in a single array('B'). Addresses are kept
+    # only for nodes that have them (1-hop neighbors and ourselves).
+    FLAGS = {'mprss': 0x01, 'local_mpr': 0x02, 'mpr': 0x04}
+
+    def __init__(self):
+        self.ids = {}  # name -> id
+        self.names = []  # id -> name, None for a free id
+        self.free = []
+        self.adj = []  # id -> array of neighbor ids
+        self.flags = array('B')
+        self.addrs = {}  # id -> list of addresses
+        self.extra = {}  # id -> {attr: value} for anything else
+        self.__init_roles__()
+
+    def __contains__(self, node):
+        return node in self.ids
+
+    def __iter__(self):
+        return iter(list(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __id__(self, node):
+        idx = self.ids.get(node)
+        if idx is None:
+            if self.free:
+                idx = self.free.pop()
+                self.names[idx] = node
+            else:
+                idx = len(self.names)
+                self.names.append(node)
+                self.adj.append(array('I'))
+                self.flags.append(0)
+            self.ids[node] = idx
+        return idx
+
+    def add_node(self, node, **attrs):
+        idx = self.__id__(node)
+        for attr, value in attrs.items():
+            bit = self.FLAGS.get(attr)
+            if bit:
+                self.flags[idx] = self.flags[idx] | bit if value else self.flags[idx] & ~bit
+            elif attr == 'addr':
+                self.addrs[idx] = list(value)
+            else:
+                self.extra.setdefault(idx, {})[attr] = value
+        self.__update_roles__(node, attrs)
+
+    def remove_node(self, node):
+        self.__drop_roles__(node)
+        idx = self.ids.pop(node)
+        for nbr in self.adj[idx]:
+            self.adj[nbr].remove(idx)
+        self.adj[idx] = array('I')
+        self.flags[idx] = 0
+        self.addrs.pop(idx, None)
+        self.extra.pop(idx, None)
+        self.names[idx] = None
+        self.free.append(idx)
+
+    def add_edge(self, u, v):
+        uid, vid = self.__id__(u), self.__id__(v)
+        if vid not in self.adj[uid]:
+            self.adj[uid].append(vid)
+            self.adj[vid].append(uid)
+
+    def remove_edge(self, u, v):
+        uid, vid = self.ids[u], self.ids[v]
+        self.adj[uid].remove(vid)
+        self.adj[vid].remove(uid)
+
+    def has_edge(self, u, v):
+        uid, vid = self.ids.get(u), self.ids.get(v)
+        return uid is not None and vid is not None and vid in self.adj[uid]
+
+    def neighbors(self, node):
+        names = self.names
+        return [names[x] for x in self.adj[self.ids[node]]]
+
+    def degree(self, node):
+        return len(self.adj[self.ids[node]])
+
+    def data(self, node):
+        idx = self.ids[node]
+        data = {attr: bool(self.flags[idx] & bit) for attr, bit in self.FLAGS.items()}
+        if idx in self.addrs:
+            data['addr'] = self.addrs[idx]
+        data.update(self.extra.get(idx, {}))
+        return data
+
+    def nodes_with(self, attr):
+        if attr in self.roles:
+            return list(self.roles[attr])
+        if attr == 'addr':
+            return [self.names[i] for i, addr in self.addrs.items() if addr]
+        return [self.names[i] for i, data in self.extra.items() if data.get(attr)]
+
+    def edges(self):
+        return [(self.names[u], self.names[v]) for u, nbrs in enumerate(self.adj) for v in nbrs if u < v]
+
+
+TOPOLOGY_STORES = {'networkx': NetworkxStore, 'compact': CompactStore}
+
+
+class DistanceIndex:
+    # Per-source BFS layers over the node's network graph, computed on first
+    # use and kept until an edge change can actually move a distance.
+    # version is bumped on every edge change and is the topology epoch other
+    # caches compare against.
+    def __init__(self, graph):
+        self.graph = graph
+        self.version = 0
+        self.cache = {}  # source -> (depth, layers, dist)
+
+    def __bfs__(self, source, depth):
+        dist = {source: 0}
+        layers = [[source]]
+        while len(layers) <= depth and layers[-1]:
+            layer = []
+            for node in layers[-1]:
+                for nbr in self.graph.neighbors(node):
+                    if nbr not in dist:
+                        dist[nbr] = len(layers)
+                        layer.append(nbr)
+            layers.append(layer)
+        return depth, layers, dist
+
+    def layers(self, source, depth):
+        entry = self.cache.get(source)
+        if entry is None or entry[0] < depth:
+            entry = self.cache[source] = self.__bfs__(source, depth)
+        return entry[1]
+
+    def at(self, source, dist):
+        if source not in self.graph:
+            return []
+        layers = self.layers(source, dist)
+        return list(layers[dist]) if dist < len(layers) else []
+
+    def distance(self, source, node, cutoff):
+        self.layers(source, cutoff)
+        return self.cache[source][2].get(node)
+
+    def edge_added(self, u, v):
+        self.version += 1
+        for source, (depth, _, dist) in list(self.cache.items()):
+            du, dv = dist.get(u), dist.get(v)
+            if du is None and dv is None:
+                # both beyond the computed depth, nothing inside it moves
+                continue
+            if du is not None and dv is not None:
+                if abs(du - dv) <= 1:
+                    continue
+            elif (du if dv is None else dv) == depth:
+                # the new endpoint lands just past the computed depth
+                continue
+            del self.cache[source]
+
+    def edge_removed(self, u, v):
+        self.version += 1
+        for source, (_, _, dist) in list(self.cache.items()):
+            du, dv = dist.get(u), dist.get(v)
+            # only an edge between consecutive BFS layers can carry a shortest path
+            if du is not None and dv is not None and abs(du - dv) == 1:
+                del self.cache[source]
+
+    def invalidate(self):
+        self.version += 1
+        self.cache.clear()
@@ -0,0 +1,232 @@
+import os
+import time
+import socket
+import struct
+import ipaddress
+import yaml
+import netifaces
+from collections import deque, defaultdict
+
+# Linux value, not every Python build exports it
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8)
+IN_PKTINFO = struct.Struct('=i4s4s')  # ifindex, spec_dst, addr
+
+
+class UdpTransport:
+    # Real sockets: a single receive socket for all interfaces is driven by
+    # Listerner, timers are left to the node's Scheduler. Every datagram is tagged with its ingress interface, taken from
+    # IP_PKTINFO or, where that is not available, from the local subnet the
+    # source address belongs to.
+    simulated = False
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, port=37020, interface_pattern='eth'):
+        self.PORT = port
+        self.UDP_IP = '<broadcast>'
+        inet = {x: netifaces.ifaddresses(x)[netifaces.AF_INET][0]
+                for x in netifaces.interfaces() if interface_pattern in x}
+        self.local_interfaces = {x: a['addr'] for x, a in inet.items()}
+        self.subnets = {
+            x: ipaddress.IPv4Network(f"{a['addr']}/{a.get('netmask', '255.255.255.255')}", strict=False)
+            for x, a in inet.items()}
+        self.ifindexes = {}  # ifindex -> iface, filled lazily
+        self.send_sockets = {}
+
+    def listen_socket(self, iface=None, timeout=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        sock.setblocking(0)
+        sock.settimeout(timeout)
+        sock.bind(('', self.PORT))
+        return sock
+
+    def iface_for(self, addr):
+        ip = ipaddress.IPv4Address(addr)
+        for iface, subnet in self.subnets.items():
+            if ip in subnet:
+                return iface
+
+    def receive_into(self, sock, buf, flags=0):
+        # (nbytes, source address, ingress interface)
+        nbytes, ancdata, _, addr = sock.recvmsg_into([buf], socket.CMSG_SPACE(IN_PKTINFO.size), flags)
+        for level, kind, data in ancdata:
+            if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                ifindex = IN_PKTINFO.unpack_from(data)[0]
+                if ifindex not in self.ifindexes:
+                    try:
+                        self.ifindexes[ifindex] = socket.if_indextoname(ifindex)
+                    except OSError:
+                        self.ifindexes[ifindex] = None
+                if self.ifindexes[ifindex] in self.local_interfaces:
+                    return nbytes, addr[0], self.ifindexes[ifindex]
+        return nbytes, addr[0], self.iface_for(addr[0])
+
+    def __send_socket__(self, iface):
+        if iface not in self.send_sockets:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.settimeout(0.2)
+            sock.setblocking(0)
+            sock.bind((self.local_interfaces[iface], 1234))
+            self.send_sockets[iface] = sock
+        return self.send_sockets[iface]
+
+    def send(self, iface, data):
+        self.__send_socket__(iface).sendto(data, (self.UDP_IP, self.PORT))
+
+    def broadcast(self, data):
+        for iface in self.local_interfaces:
+            self.send(iface, data)
+
+    def close(self):
+        for sock in self.send_sockets.values():
+            sock.close()
+        self.send_sockets.clear()
+
+
+class MemoryTransport:
+    # Endpoint of a SimulatedMesh. Nothing is sent on the wire: datagrams are
+    # queued on the mesh and handed to every other member of the network.
+    simulated = True
+
+    def __init__(self, mesh, name, local_interfaces):
+        self.mesh = mesh
+        self.clock = mesh.clock
+        self.name = name
+        self.local_interfaces = local_interfaces
+        self.networks = {}  # iface -> network
+        self.handler = None
+
+    def listen(self, handler):
+        self.handler = handler
+
+    def send(self, iface, data):
+        if iface in self.networks:
+            self.mesh.deliver(self, iface, data)
+
+    def broadcast(self, data):
+        for iface in self.local_interfaces:
+            self.send(iface, data)
+
+    def close(self):
+        self.mesh.detach(self)
+
+
+class SimulatedMesh:
+    # In-process stand-in for the docker bridge networks built by
+    # autogen/generator.py: every interface is attached to one named network
+    # and a broadcast reaches all other interfaces on it.
+    ADDR_BASE = ipaddress.IPv4Address('10.0.0.1')
+
+    def __init__(self, first_addr=0):
+        # first_addr: index of the first address handed out after ADDR_BASE,
+        # meshes sharing one address space start at different indexes
+        self.networks = defaultdict(dict)  # network -> {transport: iface}
+        self.endpoints = {}  # name -> transport
+        self.queue = deque()
+        self.now = 0.0  # virtual time, advanced by whoever drives the mesh
+        self.delivered = 0
+        self.bytes = 0
+        self.dropped = 0  # sent on a link that went down
+        self.flushed = 0  # still in flight when flush() gave up on them
+        self.__addr_idx = first_addr
+
+    @staticmethod
+    def load_configs(configs_dir):
+        configs = []
+        for fn in sorted(os.listdir(configs_dir)):
+            with open(os.path.join(configs_dir, fn)) as f:
+                configs.append(yaml.load(f, Loader=yaml.Loader))
+        return configs
+
+    @staticmethod
+    def load_edges(path):
+        # node configs from a topology.edges file of autogen/generator.py
+        networks = {}  # name -> [network, ...], in first seen order
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if not fields:
+                    continue
+                networks.setdefault(fields[0], [])
+                if len(fields) < 3:
+                    continue
+                u, v, network = fields
+                for node in (u, v) if v != '-' else (u,):
+                    joined = networks.setdefault(node, [])
+                    if network not in joined:
+                        joined.append(network)
+        return [{'name': name, 'networks': nws} for name, nws in networks.items()]
+
+    def clock(self):
+        return self.now
+
+    def __next_addr__(self):
+        addr = str(self.ADDR_BASE + self.__addr_idx)
+        self.__addr_idx += 1
+        return addr
+
+    def attach(self, name, networks):
+        # interfaces are named the same way docker names them: eth0 is the
+        # first network in the node config, eth1 the second and so on
+        local_interfaces = {}
+        transport = MemoryTransport(self, name, local_interfaces)
+        for idx, network in enumerate(networks):
+            iface = f'eth{idx}'
+            local_interfaces[iface] = self.__next_addr__()
+            transport.networks[iface] = network
+            self.networks[network][transport] = iface
+        self.endpoints[name] = transport
+        return transport
+
+    def detach(self, transport):
+        for members in self.networks.values():
+            members.pop(transport, None)
+        transport.networks.clear()
+        self.endpoints.pop(transport.name, None)
+
+    def link_down(self, transport, iface):
+        # the interface stays configured but neither sends nor receives,
+        # returns the network it was attached to
+        network = transport.networks.pop(iface)
+        self.networks[network].pop(transport, None)
+        return network
+
+    def link_up(self, transport, iface, network):
+        transport.networks[iface] = network
+        self.networks[network][transport] = iface
+
+    def deliver(self, transport, iface, data):
+        self.queue.append((transport, iface, data))
+
+    def run(self, max_datagrams=None):
+        # Drain the queue, handlers may enqueue more datagrams (TC relays,
+        # CUSTOM forwarding) which are delivered in the same call.
+        handled = 0
+        while self.queue:
+            if max_datagrams is not None and handled >= max_datagrams:
+                break
+            transport, iface, data = self.queue.popleft()
+            network = transport.networks.get(iface)
+            if network is None:
+                # the link went down while the datagram was queued
+                self.dropped += 1
+                continue
+            addr = transport.local_interfaces[iface]
+            for receiver, ingress in list(self.networks[network].items()):
+                if receiver is transport or not receiver.handler:
+                    continue
+                receiver.handler(data, addr, ingress)
+                self.delivered += 1
+                self.bytes += len(data)
+            handled += 1
+        return handled
+
+    def flush(self):
+        # forget everything still in flight, returns how many datagrams
+        flushed = len(self.queue)
+        self.flushed += flushed
+        self.queue.clear()
+        return flushed
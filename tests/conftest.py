@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the node modules import each other by bare name, as when run from node/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'node'))
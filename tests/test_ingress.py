@@ -0,0 +1,91 @@
+from ingress import IngressQueue
+from message import MessageHandler
+from packet import Packet
+
+UNLIMITED = {'HELLO': None, 'TC': None, 'CUSTOM': None}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def hello(sender, ansn=1, base_ansn=None):
+    return MessageHandler().hello_message(sender, [], ansn=ansn, base_ansn=base_ansn).make()
+
+
+def custom(sender, text='x'):
+    return MessageHandler().custom_message(sender, 'z', text).make()
+
+
+def test_priorities():
+    queue = IngressQueue(rates=UNLIMITED)
+    queue.put(custom('a'), '10.0.0.1')
+    queue.put(hello('a'), '10.0.0.1')
+    assert [x[0] for x in queue.take(10)] == [hello('a'), custom('a')]
+    assert queue.empty()
+
+
+def test_full_snapshot_coalesces_queued_messages():
+    queue = IngressQueue(rates=UNLIMITED)
+    queue.put(hello('a', 1), '10.0.0.1')
+    queue.put(hello('a', 2, base_ansn=1), '10.0.0.1')
+    queue.put(hello('b', 1), '10.0.0.2')
+    queue.put(hello('a', 3), '10.0.0.1')
+    assert queue.qsize('HELLO') == 2
+    assert queue.dropped['HELLO', 'coalesced'] == 2
+    assert [x[0] for x in queue.take(10)] == [hello('b', 1), hello('a', 3)]
+
+
+def test_deltas_are_kept():
+    queue = IngressQueue(rates=UNLIMITED)
+    queue.put(hello('a', 1), '10.0.0.1')
+    queue.put(hello('a', 2, base_ansn=1), '10.0.0.1')
+    queue.put(hello('a', 3, base_ansn=2), '10.0.0.1')
+    assert len(queue.take(10)) == 3
+    assert not queue.dropped
+
+
+def test_custom_is_shed_for_hello():
+    queue = IngressQueue(maxsize=2, rates=UNLIMITED)
+    queue.put(custom('a', 'old'), '10.0.0.1')
+    queue.put(custom('a', 'new'), '10.0.0.1')
+    assert queue.put(hello('b'), '10.0.0.2') == 1
+    assert queue.dropped['CUSTOM', 'shed'] == 1
+    assert [x[0] for x in queue.take(10)] == [hello('b'), custom('a', 'old')]
+
+
+def test_hello_is_never_shed():
+    queue = IngressQueue(maxsize=1, rates=UNLIMITED)
+    queue.put(hello('a'), '10.0.0.1')
+    assert queue.put(hello('b'), '10.0.0.2') == 0
+    assert queue.put(custom('c'), '10.0.0.3') == 0
+    assert queue.dropped['HELLO', 'full'] == 1
+    assert queue.dropped['CUSTOM', 'full'] == 1
+    assert [x[0] for x in queue.take(10)] == [hello('a')]
+
+
+def test_rate_limit_per_sender():
+    clock = Clock()
+    queue = IngressQueue(rates={'CUSTOM': (1, 2)}, clock=clock)
+    assert [queue.put(custom('a'), '10.0.0.1') for _ in range(3)] == [1, 1, 0]
+    assert queue.put(custom('b'), '10.0.0.2') == 1
+    assert queue.dropped['CUSTOM', 'rate'] == 1
+    clock.now += 1
+    assert queue.put(custom('a'), '10.0.0.1') == 1
+
+
+def test_bundled_datagram():
+    queue = IngressQueue(rates=UNLIMITED)
+    datagram, = Packet.pack([custom('a'), hello('a'), hello('b')], mtu=1500)
+    assert queue.put(datagram, '10.0.0.1', 'eth0') == 3
+    assert queue.take(10)[0] == (hello('a'), '10.0.0.1', 'eth0')
+
+
+def test_malformed_datagram():
+    queue = IngressQueue(rates=UNLIMITED)
+    assert queue.put(bytes([Packet.MAGIC, 2, 0, 50]), '10.0.0.1') == 0
+    assert queue.dropped['unknown', 'malformed'] == 1
@@ -0,0 +1,56 @@
+import socket
+import pytest
+from shards import RingBuffer
+
+
+@pytest.fixture
+def ring():
+    ring = RingBuffer(size=64)
+    yield ring
+    ring.close(unlink=True)
+
+
+def test_put_and_get(ring):
+    addr = socket.inet_aton('10.0.0.1')
+    assert ring.put(1, addr, b'abc')
+    assert ring.put(2, addr, b'')
+    assert ring.get_all() == [(1, addr, b'abc'), (2, addr, b'')]
+    assert ring.get_all() == []
+
+
+def test_full_ring_refuses(ring):
+    addr = socket.inet_aton('10.0.0.1')
+    size = ring.capacity // 2 - RingBuffer.RECORD.size
+    assert ring.put(1, addr, b'a' * size)
+    assert ring.put(1, addr, b'b' * size)
+    assert not ring.put(1, addr, b'c')
+    assert len(ring.get_all()) == 2
+    assert ring.put(1, addr, b'c')
+
+
+def test_wraparound(ring):
+    addr = socket.inet_aton('10.0.0.1')
+    sent = []
+    # records of awkward sizes split header and payload across the end
+    for idx in range(50):
+        data = bytes([idx]) * (idx % 17)
+        assert ring.put(idx, addr, data)
+        sent.append((idx, addr, data))
+        if idx % 2:
+            assert ring.get_all() == sent
+            sent = []
+    assert ring.get_all() == sent
+
+
+def test_oversized_datagram(ring):
+    with pytest.raises(ValueError):
+        ring.put(1, socket.inet_aton('10.0.0.1'), b'x' * ring.capacity)
+
+
+def test_attach_by_name(ring):
+    other = RingBuffer(ring.name)
+    try:
+        ring.put(7, socket.inet_aton('10.0.0.9'), b'hi')
+        assert other.get_all() == [(7, socket.inet_aton('10.0.0.9'), b'hi')]
+    finally:
+        other.close()
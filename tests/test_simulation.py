@@ -0,0 +1,58 @@
+import logging
+import pytest
+from simulation import Simulation
+
+LINE = [
+    {'name': 'A', 'networks': ['n0']},
+    {'name': 'B', 'networks': ['n0', 'n1']},
+    {'name': 'C', 'networks': ['n1']},
+]
+
+
+@pytest.fixture
+def logger(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    logger = logging.getLogger('test-simulation')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    return logger
+
+
+def test_link_down_is_withdrawn(logger):
+    sim = Simulation(LINE, logger=logger, broadcast_sleep=30)
+    sim.run(4)
+    a, c = sim.nodes['A'], sim.nodes['C']
+    assert a.get_neighbors(dist=2) == ['C']
+    sim.mesh.link_down(c.transport, next(iter(c.transport.networks)))
+    # B stops listing C at once, A drops it without waiting for a hold time
+    sim.run(3)
+    assert a.get_neighbors(dist=2) == []
+    assert ('B', 'C') not in a.link_timers.deadlines
+
+
+def test_gap_asks_for_full_snapshot(logger):
+    sim = Simulation(LINE, logger=logger, broadcast_sleep=30, full_snapshot_every=1000)
+    sim.run(4)
+    b = sim.nodes['B']
+    b.received.sets.pop(('HELLO', 'A'))
+    sim.round()
+    assert b.received.gapped('A')
+    assert b.received.gaps == 1
+    # B flags A for resync, A answers with a full HELLO
+    sim.run(2)
+    assert not b.received.gapped('A')
+    assert b.received.names('HELLO', 'A') == {'B'}
+
+
+def test_rounds_drain_the_mesh(logger):
+    sim = Simulation(LINE, logger=logger, broadcast_sleep=30)
+    sim.run(2)
+    assert not sim.mesh.queue
+    assert sim.mesh.flushed == 0
+
+
+def test_datagram_budget_counts_drops(logger):
+    sim = Simulation(LINE, logger=logger, datagram_budget=1, broadcast_sleep=30)
+    sim.run(2)
+    assert not sim.mesh.queue
+    assert sim.mesh.flushed > 0
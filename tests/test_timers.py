@@ -0,0 +1,41 @@
+from timers import TimerWheel
+
+
+def test_expiry():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    wheel.schedule('a', 3.5)
+    wheel.schedule('b', 5.0)
+    assert wheel.advance(3.0) == []
+    assert wheel.advance(3.5) == ['a']
+    assert wheel.advance(4.9) == []
+    assert wheel.advance(5.0) == ['b']
+    assert len(wheel) == 0
+    assert not wheel.slots
+
+
+def test_refresh_and_cancel():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    wheel.schedule('a', 2.0)
+    wheel.schedule('a', 6.0)
+    wheel.schedule('b', 2.0)
+    wheel.cancel('b')
+    wheel.cancel('missing')
+    assert wheel.advance(5.0) == []
+    assert wheel.advance(6.0) == ['a']
+
+
+def test_deadline_beyond_one_revolution():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    wheel.schedule('a', 20.0)
+    # slot 4 comes around at 4 and 12 before the deadline
+    assert wheel.advance(12.0) == []
+    assert len(wheel) == 1
+    assert wheel.advance(20.0) == ['a']
+
+
+def test_advance_past_several_revolutions():
+    wheel = TimerWheel(tick=0.5, slots=4, now=10.0)
+    for idx in range(10):
+        wheel.schedule(idx, 10.0 + idx)
+    assert sorted(wheel.advance(1000.0)) == list(range(10))
+    assert len(wheel) == 0